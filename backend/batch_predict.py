@@ -0,0 +1,177 @@
+"""
+Prédiction en masse pour /predict/batch
+Décode les patchs en parallèle, les infère par gros chunks vectorisés
+et renvoie un résultat JSON par ligne (NDJSON) dès qu'un chunk est terminé
+"""
+
+import asyncio
+import io
+import json
+import os
+import tarfile
+import zipfile
+from typing import AsyncIterator, List, Tuple
+
+import numpy as np
+from fastapi import UploadFile
+
+from inference_queue import InferenceScheduler
+from preprocessing import decode_executor, decode_image
+from script import format_prediction
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz")
+
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "256"))
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "5000"))
+BATCH_MAX_ARCHIVE_BYTES = int(os.getenv("BATCH_MAX_ARCHIVE_BYTES", str(512 * 1024 * 1024)))
+
+
+def is_archive(filename: str) -> bool:
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def _is_image_name(name: str) -> bool:
+    basename = os.path.basename(name)
+    return not basename.startswith(".") and basename.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def extract_archive(filename: str, data: bytes) -> List[Tuple[str, bytes]]:
+    """
+    Extrait les images d'une archive zip ou tar
+
+    Args:
+        filename: Nom du fichier uploadé (détermine le format)
+        data: Contenu brut de l'archive
+
+    Returns:
+        Liste de (nom du membre, contenu) pour chaque image de l'archive
+
+    Raises:
+        ValueError: Si l'archive est illisible ou dépasse les limites
+    """
+    members = []
+    total_bytes = 0
+
+    def _add(name: str, size: int, read):
+        nonlocal total_bytes
+        total_bytes += size
+        if total_bytes > BATCH_MAX_ARCHIVE_BYTES:
+            raise ValueError(f"Archive trop volumineuse une fois décompressée (> {BATCH_MAX_ARCHIVE_BYTES} octets)")
+        if len(members) >= BATCH_MAX_IMAGES:
+            raise ValueError(f"Trop d'images dans la requête (maximum {BATCH_MAX_IMAGES})")
+        members.append((name, read()))
+
+    try:
+        if filename.lower().endswith(".zip"):
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and _is_image_name(info.filename):
+                        _add(info.filename, info.file_size, lambda: archive.read(info))
+        else:
+            with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as archive:
+                for info in archive:
+                    if info.isfile() and _is_image_name(info.name):
+                        _add(info.name, info.size, lambda: archive.extractfile(info).read())
+    # Zip chiffré (RuntimeError) ou méthode de compression non prise en charge (NotImplementedError)
+    except (zipfile.BadZipFile, tarfile.TarError, RuntimeError, NotImplementedError) as e:
+        raise ValueError(f"Archive illisible '{filename}': {e}")
+
+    return members
+
+
+async def read_batch_uploads(files: List[UploadFile]) -> List[Tuple[str, bytes]]:
+    """
+    Lit les fichiers uploadés et déplie les archives éventuelles
+
+    Returns:
+        Liste ordonnée de (nom, contenu) pour chaque image à prédire
+    """
+    items = []
+    loop = asyncio.get_running_loop()
+
+    for upload in files:
+        data = await upload.read()
+        filename = upload.filename or f"image_{len(items)}"
+        if is_archive(filename):
+            items.extend(await loop.run_in_executor(decode_executor, extract_archive, filename, data))
+        else:
+            items.append((filename, data))
+        if len(items) > BATCH_MAX_IMAGES:
+            raise ValueError(f"Trop d'images dans la requête (maximum {BATCH_MAX_IMAGES})")
+
+    return items
+
+
+def _safe_preprocess(image_bytes: bytes):
+    """Renvoie (image, None) ou (None, message d'erreur) sans lever d'exception"""
+    try:
+        return decode_image(image_bytes), None
+    except Exception as e:
+        return None, str(e)
+
+
+async def _decode_chunk(chunk: List[Tuple[str, bytes]]):
+    # cv2.imdecode libère le GIL : les décodages d'un chunk tournent vraiment en parallèle
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*[
+        loop.run_in_executor(decode_executor, _safe_preprocess, data) for _, data in chunk
+    ])
+
+
+async def stream_batch_predictions(items: List[Tuple[str, bytes]],
+                                   scheduler: InferenceScheduler,
+                                   chunk_size: int = BATCH_CHUNK_SIZE,
+                                   cascade=None) -> AsyncIterator[str]:
+    """
+    Prédit toutes les images par chunks et produit une ligne JSON par image
+
+    Le décodage du chunk suivant se fait pendant l'inférence du chunk courant.
+
+    Args:
+        items: Liste de (nom, contenu) des images
+        scheduler: Ordonnanceur qui possède le thread du modèle
+        chunk_size: Nombre d'images par appel au modèle
+        cascade: Cascade d'inférence optionnelle ; chaque ligne indique alors l'étage qui a tranché
+
+    Yields:
+        Une ligne NDJSON par image, dans l'ordre d'entrée
+    """
+    chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+    next_decode = asyncio.ensure_future(_decode_chunk(chunks[0])) if chunks else None
+
+    try:
+        for chunk_index, chunk in enumerate(chunks):
+            decoded = await next_decode
+            if chunk_index + 1 < len(chunks):
+                next_decode = asyncio.ensure_future(_decode_chunk(chunks[chunk_index + 1]))
+
+            valid = [img for img, error in decoded if error is None]
+            stages = None
+            try:
+                if not valid:
+                    probas = iter([])
+                elif cascade is not None:
+                    batch_probas, batch_stages = await cascade.run_batch(np.stack(valid))
+                    probas, stages = iter(batch_probas), iter(batch_stages)
+                else:
+                    probas = iter(await scheduler.run_batch(np.stack(valid)))
+            except Exception as e:
+                # Les en-têtes 200 sont déjà partis : l'erreur est reportée sur chaque image du chunk
+                message = f"Inférence impossible: {type(e).__name__}: {e}"
+                decoded = [(img, message if error is None else error) for img, error in decoded]
+
+            base_index = chunk_index * chunk_size
+            for offset, ((name, _), (_, error)) in enumerate(zip(chunk, decoded)):
+                line = {"index": base_index + offset, "filename": name}
+                if error is None:
+                    line.update(format_prediction(next(probas)))
+                    if stages is not None:
+                        line["stage"] = next(stages)
+                else:
+                    line["error"] = error
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+    finally:
+        # Client déconnecté : ne pas laisser un décodage orphelin
+        if next_decode is not None and not next_decode.done():
+            next_decode.cancel()
@@ -0,0 +1,340 @@
+"""
+Benchmarks reproductibles du backend, hors ligne et sur CPU
+
+    python benchmark.py micro --output bench_micro.json
+    python benchmark.py load --concurrency 1,8,32 --requests 200 --output bench_load.json
+    python benchmark.py compare baseline.json bench_load.json --threshold 0.1
+
+micro : décodage, redimensionnement, normalisation et passage avant du
+modèle pour des batchs de 1 à 256 images
+load : générateur de charge en mémoire sur l'application FastAPI (main.app)
+avec des patchs synthétiques et une concurrence contrôlée
+compare : signale les régressions par rapport à un rapport de référence
+
+Sans fichier de poids, le modèle est construit par create_model et
+initialisé aléatoirement (MODEL_ALLOW_RANDOM_INIT).
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import zipfile
+from typing import Callable, Dict, List
+
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
+os.environ.setdefault("MODEL_ALLOW_RANDOM_INIT", "1")
+
+import cv2
+import numpy as np
+
+# Métriques comparées : (clé, sens) où +1 signifie « plus grand est meilleur »
+COMPARED_METRICS = (("throughput_per_s", +1), ("p50_ms", -1), ("p95_ms", -1), ("p99_ms", -1))
+
+
+def peak_rss_mb() -> float:
+    """Pic de mémoire résidente du processus (Mo)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss est en octets sous macOS, en Ko sous Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def summarize(latencies_s: List[float], items: int, elapsed_s: float) -> dict:
+    """Débit et percentiles de latence d'une série de mesures"""
+    latencies_ms = np.asarray(latencies_s) * 1000.0
+    return {
+        "iterations": len(latencies_ms),
+        "items": items,
+        "elapsed_s": round(elapsed_s, 4),
+        "throughput_per_s": round(items / elapsed_s, 2) if elapsed_s > 0 else 0.0,
+        "mean_ms": round(float(latencies_ms.mean()), 4),
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 4),
+        "p95_ms": round(float(np.percentile(latencies_ms, 95)), 4),
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 4),
+        "max_ms": round(float(latencies_ms.max()), 4),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def time_calls(fn: Callable[[], object], repeats: int, items_per_call: int = 1, warmup: int = 1) -> dict:
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(repeats):
+        call_started = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - call_started)
+    return summarize(latencies, repeats * items_per_call, time.perf_counter() - started)
+
+
+def synthetic_patch(rng: np.random.Generator, size: int = 50) -> np.ndarray:
+    """Patch BGR aux teintes hématoxyline/éosine, avec du bruit"""
+    base = np.array([rng.integers(150, 230), rng.integers(80, 160), rng.integers(150, 230)], dtype=np.int16)
+    noise = rng.integers(-40, 40, size=(size, size, 3), dtype=np.int16)
+    return np.clip(base + noise, 0, 255).astype(np.uint8)
+
+
+def encode(img: np.ndarray, ext: str = ".png") -> bytes:
+    ok, buffer = cv2.imencode(ext, img)
+    if not ok:
+        raise RuntimeError(f"Encodage {ext} impossible")
+    return buffer.tobytes()
+
+
+def environment() -> dict:
+    import model_loader
+
+    versions = {"python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__}
+    try:
+        import tensorflow as tf
+        versions["tensorflow"] = tf.__version__
+    except ImportError:
+        versions["tensorflow"] = None
+    return {
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "versions": versions,
+        "weights": "trained" if os.path.exists(model_loader.MODEL_WEIGHTS_PATH) else "random-init",
+        "settings": {key: value for key, value in sorted(os.environ.items())
+                     if key.startswith(("INFERENCE_", "PREPROCESS_", "SERVING_", "MODEL_", "TFLITE_"))},
+    }
+
+
+def run_micro(args) -> dict:
+    from preprocessing import decode_image, to_model_input
+    from script import model_loader
+
+    rng = np.random.default_rng(args.seed)
+    results: Dict[str, dict] = {}
+
+    patch_png = encode(synthetic_patch(rng))
+    region = cv2.resize(synthetic_patch(rng, 64), (args.large_size, args.large_size))
+    region_jpeg = encode(region, ".jpg")
+    decoded_region = cv2.imdecode(np.frombuffer(region_jpeg, np.uint8), cv2.IMREAD_COLOR)
+
+    results["imdecode_png_50"] = time_calls(
+        lambda: cv2.imdecode(np.frombuffer(patch_png, np.uint8), cv2.IMREAD_COLOR), args.repeats * 20)
+    results[f"imdecode_jpeg_{args.large_size}"] = time_calls(
+        lambda: cv2.imdecode(np.frombuffer(region_jpeg, np.uint8), cv2.IMREAD_COLOR), args.repeats * 5)
+    results[f"resize_{args.large_size}_to_50"] = time_calls(
+        lambda: cv2.resize(decoded_region, (50, 50)), args.repeats * 20)
+    results["decode_image_png_50"] = time_calls(lambda: decode_image(patch_png), args.repeats * 20)
+    results[f"decode_image_jpeg_{args.large_size}"] = time_calls(
+        lambda: decode_image(region_jpeg), args.repeats * 5)
+
+    print("Chargement du modèle...")
+    backend = model_loader.get_backend()
+    for batch_size in args.batch_sizes:
+        batch = np.stack([synthetic_patch(rng) for _ in range(batch_size)])
+        results[f"normalize_b{batch_size}"] = time_calls(
+            lambda: to_model_input(batch), args.repeats * 5, batch_size)
+        inputs = to_model_input(batch).copy()
+        results[f"model_forward_b{batch_size}"] = time_calls(
+            lambda: backend.predict(inputs), args.repeats, batch_size)
+        print(f"  batch {batch_size}: {results[f'model_forward_b{batch_size}']['p50_ms']:.1f} ms (p50)")
+
+    return {"backend": backend.name, "model_status": model_loader.status(), "results": results}
+
+
+def _zip_patches(patches: List[bytes]) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for index, data in enumerate(patches):
+            archive.writestr(f"patch_{index:04d}.png", data)
+    return buffer.getvalue()
+
+
+async def _drive_load(args) -> dict:
+    import httpx
+    from main import app, model_status
+
+    rng = np.random.default_rng(args.seed)
+    results: Dict[str, dict] = {}
+
+    def make_request(index: int):
+        if args.endpoint == "predict":
+            # Patchs tous différents : le cache des prédictions ne sert pas
+            return {"url": "/predict", "files": {"file": (f"p{index}.png", encode(synthetic_patch(rng)), "image/png")}}
+        if args.endpoint == "batch":
+            archive = _zip_patches([encode(synthetic_patch(rng)) for _ in range(args.batch_images)])
+            return {"url": "/predict/batch", "files": {"files": (f"b{index}.zip", archive, "application/zip")}}
+        text = " ".join(f"Phrase {index}.{sentence} sur le carcinome canalaire infiltrant." for sentence in range(20))
+        return {"url": "/flashcards", "json": {"text": text, "number_of_cards": 5}}
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=args.timeout) as client:
+            print("Attente du modèle...")
+            while not model_status()["ready"]:
+                if model_status()["status"] == "failed":
+                    raise RuntimeError(f"Échec du chargement du modèle: {model_status()['error']}")
+                await asyncio.sleep(0.2)
+
+            # Chauffe : premier batch, imports paresseux
+            await client.request("POST", **make_request(-1))
+
+            for level, concurrency in enumerate(args.concurrency):
+                # Indices distincts d'un niveau à l'autre : aucune réponse servie par un cache
+                requests = [make_request(level * args.requests + index) for index in range(args.requests)]
+                latencies, statuses = [], {}
+                next_index = 0
+
+                async def _worker():
+                    nonlocal next_index
+                    while next_index < len(requests):
+                        request = requests[next_index]
+                        next_index += 1
+                        started = time.perf_counter()
+                        response = await client.request("POST", **request)
+                        latencies.append(time.perf_counter() - started)
+                        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+                started = time.perf_counter()
+                await asyncio.gather(*[_worker() for _ in range(concurrency)])
+                elapsed = time.perf_counter() - started
+
+                items = statuses.get(200, 0) * (args.batch_images if args.endpoint == "batch" else 1)
+                summary = summarize(latencies, items, elapsed)
+                summary.update({"concurrency": concurrency, "requests": len(requests),
+                                "status_codes": {str(code): count for code, count in sorted(statuses.items())}})
+                results[f"{args.endpoint}_c{concurrency}"] = summary
+                print(f"  concurrence {concurrency}: {summary['throughput_per_s']:.1f} /s, "
+                      f"p50 {summary['p50_ms']:.1f} ms, p99 {summary['p99_ms']:.1f} ms")
+
+            stats = (await client.get("/inference/stats")).json()
+
+    return {"endpoint": args.endpoint, "backend": model_status()["backend"],
+            "inference_stats": stats, "results": results}
+
+
+def run_load(args) -> dict:
+    if args.endpoint == "flashcards":
+        os.environ.setdefault("FLASHCARD_PROVIDER", "stub")
+        # Le quota de 60 requêtes/minute est celui de Gemini : sans lui, on mesure le service
+        if os.environ["FLASHCARD_PROVIDER"] == "stub":
+            os.environ.setdefault("FLASHCARD_RATE_PER_MIN", "1000000")
+            os.environ.setdefault("FLASHCARD_RATE_BURST", "1000")
+    return asyncio.run(_drive_load(args))
+
+
+def compare_reports(baseline: dict, current: dict, threshold: float) -> List[dict]:
+    """
+    Compare deux rapports cas par cas
+
+    Returns:
+        Une ligne par (cas, métrique) commune, avec la variation relative et
+        un drapeau de régression si elle dépasse le seuil dans le mauvais sens
+    """
+    rows = []
+    for case, current_result in current.get("results", {}).items():
+        baseline_result = baseline.get("results", {}).get(case)
+        if baseline_result is None:
+            continue
+        for metric, direction in COMPARED_METRICS + (("peak_rss_mb", -1),):
+            before, after = baseline_result.get(metric), current_result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            rows.append({
+                "case": case,
+                "metric": metric,
+                "baseline": before,
+                "current": after,
+                "change": round(change, 4),
+                "regression": change * direction < -threshold,
+            })
+    return rows
+
+
+def run_compare(args) -> int:
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, "r", encoding="utf-8") as f:
+        current = json.load(f)
+
+    rows = compare_reports(baseline, current, args.threshold)
+    if not rows:
+        print("Aucun cas commun entre les deux rapports")
+        return 2
+
+    for row in rows:
+        flag = "RÉGRESSION" if row["regression"] else ""
+        print(f"{row['case']:<32} {row['metric']:<18} {row['baseline']:>12.3f} -> {row['current']:>12.3f} "
+              f"({row['change']:+.1%}) {flag}")
+
+    regressions = [row for row in rows if row["regression"]]
+    print(f"\n{len(regressions)} régression(s) au-delà de {args.threshold:.0%}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"threshold": args.threshold, "rows": rows}, f, indent=2, ensure_ascii=False)
+    return 1 if regressions else 0
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks du backend Breast Cancer API")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    micro = subparsers.add_parser("micro", help="Microbenchmarks prétraitement et modèle")
+    micro.add_argument("--batch-sizes", type=_int_list, default=[1, 8, 32, 64, 128, 256])
+    micro.add_argument("--repeats", type=int, default=10, help="Répétitions par batch du modèle")
+    micro.add_argument("--large-size", type=int, default=1024, help="Côté de l'image source volumineuse")
+
+    load = subparsers.add_parser("load", help="Charge en mémoire sur main.app")
+    load.add_argument("--endpoint", choices=("predict", "batch", "flashcards"), default="predict")
+    load.add_argument("--concurrency", type=_int_list, default=[1, 8, 32])
+    load.add_argument("--requests", type=int, default=200, help="Requêtes par niveau de concurrence")
+    load.add_argument("--batch-images", type=int, default=64, help="Images par requête /predict/batch")
+    load.add_argument("--timeout", type=float, default=300.0)
+
+    for sub in (micro, load):
+        sub.add_argument("--seed", type=int, default=0)
+        sub.add_argument("--output", help="Fichier JSON du rapport")
+        sub.add_argument("--baseline", help="Rapport de référence à comparer au résultat")
+        sub.add_argument("--threshold", type=float, default=0.1, help="Variation relative tolérée")
+
+    compare = subparsers.add_parser("compare", help="Compare un rapport à une référence")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=0.1, help="Variation relative tolérée")
+    compare.add_argument("--output", help="Fichier JSON du comparatif")
+
+    args = parser.parse_args(argv)
+    if args.mode == "compare":
+        return run_compare(args)
+
+    np.random.seed(args.seed)
+    started_at = time.time()
+    report = run_micro(args) if args.mode == "micro" else run_load(args)
+    report.update({
+        "mode": args.mode,
+        "started_at": started_at,
+        "duration_s": round(time.time() - started_at, 2),
+        "environment": environment(),
+        "arguments": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    })
+
+    output = args.output or f"benchmark_{args.mode}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False, default=str)
+    print(f"Rapport écrit dans {output} (pic RSS {report['peak_rss_mb']:.0f} Mo)")
+
+    if args.baseline:
+        args.current = output
+        args.output = None
+        return run_compare(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+"""
+Cascade d'inférence à deux étages
+Un petit CNN distillé depuis ResNet50 (train_cascade.py) score chaque
+patch ; seuls les patchs dont la probabilité tombe dans la bande
+d'incertitude autour du seuil 0.5 sont transmis à ResNet50
+"""
+
+import json
+import os
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from metrics import CASCADE_DECISIONS, PREDICT_STAGE
+from model_loader import MODEL_DIR, ModelNotReadyError, weights_fingerprint
+from preprocessing import to_model_input
+
+INFERENCE_CASCADE = os.getenv("INFERENCE_CASCADE", "0") == "1"
+CASCADE_STUDENT_WEIGHTS = os.getenv("CASCADE_STUDENT_WEIGHTS", os.path.join(MODEL_DIR, "student.weights.h5"))
+# Bande calibrée par train_cascade.py (student.json), sinon valeurs par défaut
+CASCADE_STUDENT_METADATA = os.getenv("CASCADE_STUDENT_METADATA", os.path.join(MODEL_DIR, "student.json"))
+CASCADE_BAND_LOW = os.getenv("CASCADE_BAND_LOW")
+CASCADE_BAND_HIGH = os.getenv("CASCADE_BAND_HIGH")
+DEFAULT_BAND = (0.1, 0.9)
+DECISION_THRESHOLD = 0.5
+
+STAGE_STUDENT = "student"
+STAGE_TEACHER = "resnet50"
+
+
+def create_student_model(input_shape=(50, 50, 3)):
+    """CNN léger du premier étage (~70 k paramètres), même entrée que create_model"""
+    # Import local : importer ce module ne doit pas charger TensorFlow
+    from tensorflow.keras import Input
+    from tensorflow.keras.models import Model
+    from tensorflow.keras.layers import (BatchNormalization, Conv2D, Dense, Dropout, GlobalAveragePooling2D,
+                                         MaxPooling2D)
+
+    inputs = Input(shape=input_shape)
+    x = inputs
+    for filters in (16, 32, 64):
+        x = Conv2D(filters, 3, padding='same', activation='relu', use_bias=False)(x)
+        x = BatchNormalization()(x)
+        x = Conv2D(filters, 3, padding='same', activation='relu')(x)
+        x = MaxPooling2D()(x)
+    x = GlobalAveragePooling2D()(x)
+    x = Dropout(0.2)(x)
+    predictions = Dense(1, activation='sigmoid')(x)
+    return Model(inputs=inputs, outputs=predictions)
+
+
+def read_band(metadata_path: str = CASCADE_STUDENT_METADATA) -> Tuple[float, float]:
+    """
+    Bande d'incertitude [bas, haut] : variables d'environnement, sinon student.json
+
+    Raises:
+        ValueError: Si la bande n'encadre pas le seuil de décision
+    """
+    low, high = DEFAULT_BAND
+    if os.path.exists(metadata_path):
+        with open(metadata_path, "r", encoding="utf-8") as f:
+            band = json.load(f).get("band", {})
+        low, high = band.get("low", low), band.get("high", high)
+    if CASCADE_BAND_LOW is not None:
+        low = float(CASCADE_BAND_LOW)
+    if CASCADE_BAND_HIGH is not None:
+        high = float(CASCADE_BAND_HIGH)
+    if not 0.0 <= low <= DECISION_THRESHOLD <= high <= 1.0:
+        raise ValueError(f"Bande de la cascade invalide: [{low}, {high}] (doit encadrer {DECISION_THRESHOLD})")
+    return float(low), float(high)
+
+
+class StudentModel:
+    """Modèle du premier étage : reconstruit par create_student_model, poids chargés une seule fois"""
+
+    def __init__(self, weights_path: str = CASCADE_STUDENT_WEIGHTS, input_shape=(50, 50, 3)):
+        self.weights_path = weights_path
+        self.input_shape = input_shape
+        self.state = "pending"
+        self.error: Optional[str] = None
+        self.fingerprint: Optional[str] = None
+        self.load_ms: Optional[float] = None
+        self._backend = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._backend is not None
+
+    def start_background(self):
+        """Lance le chargement dans un thread démon, comme ModelLoader.start_background"""
+        if self._thread is not None or self.ready:
+            return
+        self._thread = threading.Thread(target=self._load_quietly, name="student-loader", daemon=True)
+        self._thread.start()
+
+    def _load_quietly(self):
+        try:
+            self.load()
+        except ModelNotReadyError:
+            # L'erreur est conservée dans self.error et exposée par /inference/cascade
+            pass
+
+    def load(self):
+        """
+        Raises:
+            ModelNotReadyError: Si les poids du premier étage sont introuvables ou invalides
+        """
+        with self._lock:
+            if self._backend is not None:
+                return
+            if self.state == "failed":
+                raise ModelNotReadyError(self.error)
+
+            started = time.perf_counter()
+            try:
+                # Même import que ModelLoader : sûr pendant le chargement de ResNet50 dans un autre thread
+                from tensorflow import keras  # noqa: F401
+                from inference_backends import CompiledBackend
+
+                if not os.path.exists(self.weights_path):
+                    raise FileNotFoundError(
+                        f"Poids du premier étage introuvables: {self.weights_path} (voir train_cascade.py)"
+                    )
+                model = create_student_model(self.input_shape)
+                model.load_weights(self.weights_path)
+                backend = CompiledBackend(model)
+                backend.predict(np.zeros((1,) + tuple(self.input_shape), dtype=np.float32))
+                self.fingerprint = weights_fingerprint(self.weights_path)
+            except Exception as e:
+                self.state = "failed"
+                self.error = f"{type(e).__name__}: {e}"
+                print(f"⚠️ Cascade désactivée, tous les patchs iront à ResNet50: {self.error}")
+                raise ModelNotReadyError(self.error) from e
+
+            self.load_ms = round((time.perf_counter() - started) * 1000.0, 1)
+            self._backend = backend
+            self.state = "ready"
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        """Probabilités du premier étage pour un batch BGR uint8 (N, 50, 50, 3)"""
+        if self._backend is None:
+            self.load()
+        inputs = to_model_input(batch)
+        with PREDICT_STAGE.time(stage="student_model"):
+            return self._backend.predict(inputs)
+
+    def status(self) -> dict:
+        return {
+            "status": self.state,
+            "error": self.error,
+            "weights_path": self.weights_path,
+            "weights_fingerprint": self.fingerprint,
+            "load_ms": self.load_ms,
+        }
+
+
+class InferenceCascade:
+    """
+    Aiguille chaque patch entre le premier étage et ResNet50
+
+    Les deux étages ont chacun leur ordonnanceur de micro-batchs : les
+    patchs escaladés sont regroupés entre eux avant de passer dans ResNet50.
+    Tant que le premier étage n'est pas chargé, tout va à ResNet50.
+    """
+
+    def __init__(self, student: StudentModel, student_scheduler, teacher_scheduler,
+                 band: Optional[Tuple[float, float]] = None):
+        self.student = student
+        self.student_scheduler = student_scheduler
+        self.teacher_scheduler = teacher_scheduler
+        self.low, self.high = band or read_band()
+        self._decisions = {STAGE_STUDENT: 0, STAGE_TEACHER: 0}
+
+    async def start(self):
+        """
+        Démarre l'ordonnanceur du premier étage et lance le chargement de ses
+        poids en arrière-plan : d'ici là (ou en cas d'échec), tout va à ResNet50
+        """
+        await self.student_scheduler.start()
+        self.student.start_background()
+
+    async def stop(self):
+        await self.student_scheduler.stop()
+
+    def escalates(self, probas):
+        return (probas >= self.low) & (probas <= self.high)
+
+    def _record(self, stage: str, count: int = 1):
+        if count:
+            self._decisions[stage] += count
+            CASCADE_DECISIONS.inc(count, stage=stage)
+
+    async def submit(self, sample: np.ndarray) -> Tuple[float, str]:
+        """
+        Returns:
+            (probabilité, étage qui a tranché)
+        """
+        if self.student.ready:
+            proba = await self.student_scheduler.submit(sample)
+            if not self.escalates(proba):
+                self._record(STAGE_STUDENT)
+                return proba, STAGE_STUDENT
+        proba = await self.teacher_scheduler.submit(sample)
+        self._record(STAGE_TEACHER)
+        return proba, STAGE_TEACHER
+
+    async def run_batch(self, samples: np.ndarray) -> Tuple[np.ndarray, List[str]]:
+        """
+        Batch déjà constitué : un appel au premier étage, puis un appel à
+        ResNet50 pour les seuls patchs escaladés
+
+        Returns:
+            (N probabilités, étage qui a tranché pour chaque patch)
+        """
+        if not self.student.ready:
+            probas = await self.teacher_scheduler.run_batch(samples)
+            self._record(STAGE_TEACHER, len(samples))
+            return probas, [STAGE_TEACHER] * len(samples)
+
+        probas = np.array(await self.student_scheduler.run_batch(samples), dtype=np.float32)
+        escalated = self.escalates(probas)
+        if escalated.any():
+            probas[escalated] = await self.teacher_scheduler.run_batch(samples[escalated])
+        count = int(escalated.sum())
+        self._record(STAGE_TEACHER, count)
+        self._record(STAGE_STUDENT, len(samples) - count)
+        return probas, [STAGE_TEACHER if flag else STAGE_STUDENT for flag in escalated]
+
+    def escalation_rate(self) -> float:
+        total = sum(self._decisions.values())
+        return self._decisions[STAGE_TEACHER] / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "band": {"low": self.low, "high": self.high},
+            "decisions": dict(self._decisions),
+            "escalation_rate": self.escalation_rate(),
+            "student": self.student.status(),
+            "student_batches": self.student_scheduler.stats(),
+        }
@@ -0,0 +1,468 @@
+"""
+Couche fournisseur pour la génération de flashcards
+Client Gemini asynchrone configuré une seule fois, cache des réponses
+(TTL + taille), limiteur de concurrence et seau à jetons respectant le
+quota de requêtes par minute, et fournisseur local pour les tests de charge.
+Mode documents longs : découpage en morceaux générés en parallèle et
+flashcards diffusées au fil de la génération
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, List, Optional
+
+from metrics import FLASHCARD_CALLS_IN_FLIGHT, FLASHCARD_INPUT_CHARS, FLASHCARD_STAGE
+from flashcard_service import (FlashCard, FlashCardConfig, FlashcardStreamParser, create_flashcard_prompt,
+                               gemini_generation_config, is_near_duplicate, parse_flashcards,
+                               question_tokens, split_into_chunks)
+
+FLASHCARD_PROVIDERS = ("gemini", "stub")
+FLASHCARD_PROVIDER = os.getenv("FLASHCARD_PROVIDER", "gemini")
+FLASHCARD_MODEL = os.getenv("FLASHCARD_MODEL", "gemini-1.5-flash")
+FLASHCARD_TIMEOUT_S = float(os.getenv("FLASHCARD_TIMEOUT_S", "60"))
+
+FLASHCARD_CACHE_SIZE = int(os.getenv("FLASHCARD_CACHE_SIZE", "256"))
+FLASHCARD_CACHE_TTL_S = float(os.getenv("FLASHCARD_CACHE_TTL_S", "3600"))
+
+# Quota Gemini gratuit : 60 requêtes/minute. Avec une rafale de 5 jetons et
+# 55 jetons/minute, aucune fenêtre de 60 s ne dépasse 60 requêtes
+FLASHCARD_RATE_PER_MIN = float(os.getenv("FLASHCARD_RATE_PER_MIN", "55"))
+FLASHCARD_RATE_BURST = int(os.getenv("FLASHCARD_RATE_BURST", "5"))
+FLASHCARD_MAX_CONCURRENCY = int(os.getenv("FLASHCARD_MAX_CONCURRENCY", "4"))
+# Au-delà de cette attente pour un jeton, la requête est refusée (429)
+FLASHCARD_MAX_QUEUE_S = float(os.getenv("FLASHCARD_MAX_QUEUE_S", "30"))
+
+FLASHCARD_STUB_LATENCY_MS = float(os.getenv("FLASHCARD_STUB_LATENCY_MS", "0"))
+
+# Mode documents longs
+FLASHCARD_CHUNK_CHARS = int(os.getenv("FLASHCARD_CHUNK_CHARS", "4000"))
+FLASHCARD_CHUNK_CONCURRENCY = int(os.getenv("FLASHCARD_CHUNK_CONCURRENCY", "3"))
+FLASHCARD_DEDUP_THRESHOLD = float(os.getenv("FLASHCARD_DEDUP_THRESHOLD", "0.8"))
+
+# Nombre de GenerativeModel conservés (un par prompt système distinct)
+_MAX_CACHED_MODELS = 32
+
+
+class FlashcardRateLimitError(RuntimeError):
+    """Quota de requêtes atteint ; porte le délai conseillé avant de réessayer"""
+
+    def __init__(self, retry_after_s: float):
+        super().__init__(f"Quota de génération atteint, réessayez dans {retry_after_s:.0f} s")
+        self.retry_after_s = retry_after_s
+
+
+class TokenBucket:
+    """
+    Seau à jetons asynchrone
+
+    Chaque appel réserve un jeton, quitte à rendre le solde négatif : la
+    dette fixe l'attente, et les appelants sont servis dans l'ordre.
+    """
+
+    def __init__(self, rate_per_min: float, burst: int, max_wait_s: float):
+        if rate_per_min <= 0 or burst < 1:
+            raise ValueError("FLASHCARD_RATE_PER_MIN doit être > 0 et FLASHCARD_RATE_BURST >= 1")
+        self.rate_per_s = rate_per_min / 60.0
+        self.burst = burst
+        self.max_wait_s = max_wait_s
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self.throttled = 0
+        self.rejected = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate_per_s)
+        self._updated_at = now
+
+    async def acquire(self):
+        """
+        Attend un jeton
+
+        Raises:
+            FlashcardRateLimitError: Si l'attente dépasserait max_wait_s
+        """
+        self._refill()
+        wait_s = (1.0 - self._tokens) / self.rate_per_s if self._tokens < 1.0 else 0.0
+        if wait_s > self.max_wait_s:
+            self.rejected += 1
+            raise FlashcardRateLimitError(wait_s)
+
+        self._tokens -= 1.0
+        if wait_s > 0:
+            self.throttled += 1
+            await asyncio.sleep(wait_s)
+
+    def stats(self) -> dict:
+        self._refill()
+        return {
+            "rate_per_min": self.rate_per_s * 60.0,
+            "burst": self.burst,
+            "tokens": round(self._tokens, 3),
+            "throttled": self.throttled,
+            "rejected": self.rejected,
+        }
+
+
+class ResponseCache:
+    """LRU des flashcards générées, avec durée de vie par entrée"""
+
+    def __init__(self, max_entries: int = FLASHCARD_CACHE_SIZE, ttl_s: float = FLASHCARD_CACHE_TTL_S):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    @staticmethod
+    def make_key(provider: str, text: str, config: FlashCardConfig) -> str:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        fields = (config.max_question_words, config.max_answer_words, config.number_of_cards, config.temperature)
+        return f"{provider}:{text_hash}:{fields}"
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        if self.max_entries <= 0:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, cards = entry
+            if time.monotonic() < expires_at:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cards
+            del self._entries[key]
+            self.expired += 1
+        self.misses += 1
+        return None
+
+    def put(self, key: str, cards: List[dict]):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_s, cards)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl_s,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class GeminiProvider:
+    """
+    Fournisseur Google Gemini
+
+    L'API est configurée une seule fois et le client asynchrone (canal gRPC)
+    est réutilisé par toutes les requêtes ; un GenerativeModel est conservé
+    par prompt système.
+    """
+
+    name = "gemini"
+
+    def __init__(self, model_name: str = FLASHCARD_MODEL, timeout_s: float = FLASHCARD_TIMEOUT_S):
+        self.model_name = model_name
+        self.timeout_s = timeout_s
+        self._genai = None
+        self._models = OrderedDict()
+
+    def _configure(self):
+        if self._genai is not None:
+            return self._genai
+        api_key = os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            raise ValueError("GEMINI_API_KEY non configurée dans le fichier .env")
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        self._genai = genai
+        return genai
+
+    def _get_model(self, system_prompt: str):
+        model = self._models.get(system_prompt)
+        if model is None:
+            genai = self._configure()
+            model = genai.GenerativeModel(model_name=self.model_name, system_instruction=system_prompt)
+            self._models[system_prompt] = model
+            while len(self._models) > _MAX_CACHED_MODELS:
+                self._models.popitem(last=False)
+        else:
+            self._models.move_to_end(system_prompt)
+        return model
+
+    async def complete(self, system_prompt: str, user_prompt: str, config: FlashCardConfig) -> str:
+        """Renvoie le texte brut de la réponse du modèle"""
+        model = self._get_model(system_prompt)
+        response = await model.generate_content_async(
+            user_prompt,
+            generation_config=gemini_generation_config(config),
+            request_options={"timeout": self.timeout_s},
+        )
+        if not response.text:
+            raise ValueError("Réponse vide de Gemini API")
+        return response.text
+
+    async def stream(self, system_prompt: str, user_prompt: str, config: FlashCardConfig) -> AsyncIterator[str]:
+        """Produit le texte de la réponse au fur et à mesure de sa génération"""
+        model = self._get_model(system_prompt)
+        response = await model.generate_content_async(
+            user_prompt,
+            generation_config=gemini_generation_config(config),
+            request_options={"timeout": self.timeout_s},
+            stream=True,
+        )
+        async for part in response:
+            if part.text:
+                yield part.text
+
+
+class StubProvider:
+    """
+    Fournisseur local sans réseau, pour les tests de charge
+
+    Construit des flashcards à partir des phrases du texte, au même format
+    JSON que Gemini, après une latence simulée.
+    """
+
+    name = "stub"
+
+    def __init__(self, latency_ms: float = FLASHCARD_STUB_LATENCY_MS):
+        self.latency_ms = latency_ms
+
+    async def complete(self, system_prompt: str, user_prompt: str, config: FlashCardConfig) -> str:
+        if self.latency_ms > 0:
+            await asyncio.sleep(self.latency_ms / 1000.0)
+        return self._build_response(user_prompt, config)
+
+    async def stream(self, system_prompt: str, user_prompt: str, config: FlashCardConfig) -> AsyncIterator[str]:
+        """Découpe la réponse en fragments, la latence simulée étant répartie entre eux"""
+        raw = self._build_response(user_prompt, config)
+        fragment_size = 64
+        fragments = [raw[start:start + fragment_size] for start in range(0, len(raw), fragment_size)]
+        for fragment in fragments:
+            if self.latency_ms > 0:
+                await asyncio.sleep(self.latency_ms / 1000.0 / len(fragments))
+            yield fragment
+
+    @staticmethod
+    def _build_response(user_prompt: str, config: FlashCardConfig) -> str:
+        text = user_prompt.split("\n\n", 1)[-1]
+        sentences = [s.strip() for s in re.split(r"(?<=[.!?])\s+", text) if s.strip()] or [text.strip()]
+        cards = []
+        for i in range(config.number_of_cards):
+            words = sentences[i % len(sentences)].split()
+            subject = " ".join(words[:max(1, config.max_question_words - 6)])
+            cards.append({
+                "question": f"Que dit le texte à propos de « {subject} » ?",
+                "answer": " ".join(words[:config.max_answer_words]),
+            })
+        return json.dumps({"flashcards": cards}, ensure_ascii=False)
+
+
+def create_provider(name: str = FLASHCARD_PROVIDER):
+    if name == "gemini":
+        return GeminiProvider()
+    if name == "stub":
+        return StubProvider()
+    raise ValueError(f"FLASHCARD_PROVIDER invalide: {name} (valeurs possibles: {', '.join(FLASHCARD_PROVIDERS)})")
+
+
+class FlashcardGenerator:
+    """
+    Génération asynchrone de flashcards : cache, limitation de débit, fournisseur
+
+    Les requêtes identiques simultanées partagent un seul appel au fournisseur.
+    """
+
+    def __init__(self, provider=None, cache: Optional[ResponseCache] = None,
+                 bucket: Optional[TokenBucket] = None, max_concurrency: int = FLASHCARD_MAX_CONCURRENCY):
+        self.provider = provider or create_provider()
+        self.cache = cache or ResponseCache()
+        self.bucket = bucket or TokenBucket(FLASHCARD_RATE_PER_MIN, FLASHCARD_RATE_BURST, FLASHCARD_MAX_QUEUE_S)
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._pending = {}
+        self.provider_calls = 0
+        self.errors = 0
+
+    async def generate(self, text: str, config: Optional[FlashCardConfig] = None) -> List[FlashCard]:
+        """
+        Génère des flashcards à partir d'un texte
+
+        Raises:
+            ValueError: Configuration manquante ou réponse illisible
+            FlashcardRateLimitError: Quota de requêtes atteint
+        """
+        if config is None:
+            config = FlashCardConfig()
+        FLASHCARD_INPUT_CHARS.observe(len(text))
+
+        key = ResponseCache.make_key(self.provider.name, text, config)
+        cards = self.cache.get(key)
+        if cards is None:
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = asyncio.ensure_future(self._call_provider(key, text, config))
+                self._pending[key] = pending
+                pending.add_done_callback(lambda _: self._pending.pop(key, None))
+            with FLASHCARD_STAGE.time(stage="total"):
+                cards = await asyncio.shield(pending)
+
+        return [FlashCard(card["question"], card["answer"]) for card in cards]
+
+    async def _acquire_slot(self):
+        with FLASHCARD_STAGE.time(stage="rate_limit_wait"):
+            await self.bucket.acquire()
+            await self._semaphore.acquire()
+        self.provider_calls += 1
+        FLASHCARD_CALLS_IN_FLIGHT.inc()
+
+    def _release_slot(self):
+        FLASHCARD_CALLS_IN_FLIGHT.dec()
+        self._semaphore.release()
+
+    async def _call_provider(self, key: str, text: str, config: FlashCardConfig) -> List[dict]:
+        system_prompt, user_prompt = create_flashcard_prompt(text, config)
+        await self._acquire_slot()
+        try:
+            with FLASHCARD_STAGE.time(stage="provider"):
+                raw = await self.provider.complete(system_prompt, user_prompt, config)
+            with FLASHCARD_STAGE.time(stage="parse"):
+                cards = [card.to_dict() for card in parse_flashcards(raw)]
+        except Exception as e:
+            self.errors += 1
+            print(f"⚠️ Erreur du fournisseur {self.provider.name}: {e}")
+            if isinstance(e, ValueError):
+                raise
+            raise ValueError(f"Erreur lors de la génération des flashcards: {e}")
+        finally:
+            self._release_slot()
+
+        self.cache.put(key, cards)
+        return cards
+
+    async def stream(self, text: str, config: Optional[FlashCardConfig] = None,
+                     chunk_chars: int = FLASHCARD_CHUNK_CHARS,
+                     chunk_concurrency: int = FLASHCARD_CHUNK_CONCURRENCY,
+                     dedup_threshold: float = FLASHCARD_DEDUP_THRESHOLD) -> AsyncIterator[dict]:
+        """
+        Génère les flashcards d'un long document et les produit dès leur extraction
+
+        Le texte est découpé en morceaux générés en parallèle (au plus
+        chunk_concurrency à la fois) ; le nombre de cartes demandé est réparti
+        au prorata de la taille des morceaux. Les quasi-doublons entre
+        morceaux sont écartés.
+
+        Yields:
+            {"chunk", "question", "answer"} par carte, {"chunk", "error"} si un
+            morceau échoue, puis un résumé {"done": True, ...}
+        """
+        if config is None:
+            config = FlashCardConfig()
+        FLASHCARD_INPUT_CHARS.observe(len(text))
+        started = time.perf_counter()
+        chunks = split_into_chunks(text, chunk_chars)
+        total_chars = sum(len(chunk) for chunk in chunks) or 1
+
+        events = asyncio.Queue()
+        chunk_slots = asyncio.Semaphore(chunk_concurrency)
+
+        async def _run_chunk(index: int, chunk: str):
+            chunk_config = (FlashCardConfig()
+                            .set_max_question_words(config.max_question_words)
+                            .set_max_answer_words(config.max_answer_words)
+                            .set_temperature(config.temperature)
+                            .set_number_of_cards(max(1, round(config.number_of_cards * len(chunk) / total_chars))))
+            try:
+                async with chunk_slots:
+                    async for card in self._stream_chunk(chunk, chunk_config):
+                        await events.put((index, card, None))
+            except Exception as e:
+                await events.put((index, None, str(e)))
+            finally:
+                await events.put((index, None, None))
+
+        tasks = [asyncio.ensure_future(_run_chunk(index, chunk)) for index, chunk in enumerate(chunks)]
+        seen: List[set] = []
+        emitted = duplicates = failed = 0
+        remaining = len(tasks)
+
+        try:
+            while remaining:
+                index, card, error = await events.get()
+                if error is not None:
+                    failed += 1
+                    yield {"chunk": index, "error": error}
+                elif card is None:
+                    remaining -= 1
+                elif emitted < config.number_of_cards:
+                    tokens = question_tokens(card.question)
+                    if is_near_duplicate(tokens, seen, dedup_threshold):
+                        duplicates += 1
+                        continue
+                    seen.append(tokens)
+                    if not emitted:
+                        FLASHCARD_STAGE.observe(time.perf_counter() - started, stage="first_card")
+                    emitted += 1
+                    yield {"chunk": index, **card.to_dict()}
+        finally:
+            # Client déconnecté : arrêter les morceaux encore en cours
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+        FLASHCARD_STAGE.observe(time.perf_counter() - started, stage="total")
+        yield {"done": True, "total": emitted, "chunks": len(chunks),
+               "failed_chunks": failed, "duplicates_removed": duplicates}
+
+    async def _stream_chunk(self, text: str, config: FlashCardConfig) -> AsyncIterator[FlashCard]:
+        """Flashcards d'un morceau, depuis le cache ou au fil de la réponse du fournisseur"""
+        key = ResponseCache.make_key(self.provider.name, text, config)
+        cached = self.cache.get(key)
+        if cached is not None:
+            for card in cached:
+                yield FlashCard(card["question"], card["answer"])
+            return
+
+        system_prompt, user_prompt = create_flashcard_prompt(text, config)
+        parser = FlashcardStreamParser()
+        cards = []
+        await self._acquire_slot()
+        try:
+            with FLASHCARD_STAGE.time(stage="provider"):
+                async for fragment in self.provider.stream(system_prompt, user_prompt, config):
+                    for card in parser.feed(fragment):
+                        cards.append(card.to_dict())
+                        yield card
+        except Exception as e:
+            self.errors += 1
+            print(f"⚠️ Erreur du fournisseur {self.provider.name}: {e}")
+            raise
+        finally:
+            self._release_slot()
+
+        if cards:
+            self.cache.put(key, cards)
+
+    def stats(self) -> dict:
+        return {
+            "provider": self.provider.name,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": len(self._pending),
+            "provider_calls": self.provider_calls,
+            "errors": self.errors,
+            "cache": self.cache.stats(),
+            "rate_limit": self.bucket.stats(),
+        }
@@ -4,8 +4,9 @@ Solution 100% gratuite avec 60 requêtes par minute
 """
 
 import os
+import re
 import json
-from typing import List, Optional
+from typing import List, Optional, Set
 from dotenv import load_dotenv
 import google.generativeai as genai
 
@@ -136,10 +137,161 @@ def parse_flashcards(json_content: str) -> List[FlashCard]:
     return flash_cards
 
 
+class FlashcardStreamParser:
+    """
+    Parseur JSON incrémental pour une réponse en cours de génération
+    
+    Extrait chaque objet du tableau "flashcards" dès que son accolade
+    fermante est reçue, sans attendre la fin de la réponse.
+    """
+    
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._in_array = False
+        self._object_start = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+    
+    def feed(self, fragment: str) -> List[FlashCard]:
+        """
+        Ajoute un fragment de texte et renvoie les flashcards complétées
+        
+        Args:
+            fragment: Suite de la réponse du modèle
+            
+        Returns:
+            Les flashcards dont l'objet JSON s'est terminé dans ce fragment
+        """
+        self._buffer += fragment
+        cards = []
+        
+        if not self._in_array:
+            key = self._buffer.find('"flashcards"')
+            bracket = self._buffer.find("[", key) if key != -1 else -1
+            if bracket == -1:
+                return cards
+            self._in_array = True
+            self._pos = bracket + 1
+        
+        buffer = self._buffer
+        i = self._pos
+        while i < len(buffer):
+            char = buffer[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                if self._depth == 0:
+                    self._object_start = i
+                self._depth += 1
+            elif char == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    card = self._parse_object(buffer[self._object_start:i + 1])
+                    if card is not None:
+                        cards.append(card)
+                    self._object_start = None
+            i += 1
+        
+        # Ne conserver que l'objet en cours pour borner la mémoire
+        if self._object_start is None:
+            self._buffer, self._pos = "", 0
+        else:
+            self._buffer = buffer[self._object_start:]
+            self._pos = i - self._object_start
+            self._object_start = 0
+        return cards
+    
+    @staticmethod
+    def _parse_object(raw: str) -> Optional[FlashCard]:
+        try:
+            card_data = json.loads(raw)
+        except json.JSONDecodeError:
+            print(f"⚠️ Flashcard illisible ignorée: {raw[:200]}")
+            return None
+        question = card_data.get("question", "")
+        answer = card_data.get("answer", "")
+        if question and answer:
+            return FlashCard(question, answer)
+        return None
+
+
+def split_into_chunks(text: str, max_chars: int) -> List[str]:
+    """
+    Découpe un long texte en morceaux cohérents d'au plus max_chars caractères
+    
+    Les paragraphes sont regroupés tant qu'ils tiennent dans un morceau ;
+    un paragraphe trop long est découpé entre deux phrases.
+    
+    Args:
+        text: Le texte source
+        max_chars: Taille maximale d'un morceau
+        
+    Returns:
+        Liste des morceaux, dans l'ordre du texte
+    """
+    units = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            units.append(paragraph)
+            continue
+        for sentence in re.split(r"(?<=[.!?;])\s+", paragraph):
+            # Une phrase démesurée est coupée sans plus de ménagement
+            units.extend(sentence[start:start + max_chars] for start in range(0, len(sentence), max_chars))
+    
+    chunks, current = [], ""
+    for unit in units:
+        if current and len(current) + 2 + len(unit) > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{unit}" if current else unit
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def question_tokens(question: str) -> Set[str]:
+    """Mots significatifs d'une question, pour la détection de quasi-doublons"""
+    return {word for word in re.findall(r"\w+", question.lower()) if len(word) > 2}
+
+
+def is_near_duplicate(tokens: Set[str], seen: List[Set[str]], threshold: float) -> bool:
+    """Vrai si la similarité de Jaccard avec une question déjà vue atteint le seuil"""
+    for other in seen:
+        union = len(tokens | other)
+        if union and len(tokens & other) / union >= threshold:
+            return True
+    return False
+
+
+def gemini_generation_config(config: FlashCardConfig) -> dict:
+    """Paramètres de génération Gemini pour une configuration donnée"""
+    return {
+        "temperature": config.temperature,
+        "top_p": 0.8,
+        "top_k": 40,
+        "max_output_tokens": 2048,  # Plus de tokens pour plusieurs flashcards
+    }
+
+
 def generate_flashcards(text: str, config: Optional[FlashCardConfig] = None) -> List[FlashCard]:
     """
     Génère des flashcards à partir d'un texte en utilisant Google Gemini API
     
+    Appel bloquant ; le serveur utilise la version asynchrone de
+    flashcard_providers.FlashcardGenerator.
+    
     Args:
         text: Le texte source pour générer les flashcards
         config: Configuration optionnelle (utilise les valeurs par défaut si non fournie)
@@ -175,12 +327,7 @@ def generate_flashcards(text: str, config: Optional[FlashCardConfig] = None) ->
         # Générer la réponse
         response = model.generate_content(
             user_prompt,
-            generation_config={
-                "temperature": config.temperature,
-                "top_p": 0.8,
-                "top_k": 40,
-                "max_output_tokens": 2048,  # Plus de tokens pour plusieurs flashcards
-            }
+            generation_config=gemini_generation_config(config)
         )
         
         # Extraire le texte de la réponse
@@ -0,0 +1,334 @@
+"""
+Historique des analyses côté serveur
+Une ligne SQLite par prédiction (index sur l'utilisateur et la date), image
+stockée une seule fois dans un dossier adressé par contenu avec une
+miniature, et listes paginées par curseur
+"""
+
+import base64
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Optional
+from urllib.parse import urlencode
+
+import cv2
+import numpy as np
+
+from preprocessing import read_image_size
+
+HISTORY_DB = os.getenv("HISTORY_DB", "history.db")
+HISTORY_BLOB_DIR = os.getenv("HISTORY_BLOB_DIR", "history_blobs")
+HISTORY_THUMBNAIL_SIZE = int(os.getenv("HISTORY_THUMBNAIL_SIZE", "128"))
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+THUMBNAIL_JPEG_QUALITY = 80
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "tif": "image/tiff",
+    "tiff": "image/tiff",
+    "bmp": "image/bmp",
+}
+
+# Colonnes renvoyées par les listes : aucune donnée d'image
+_LIST_COLUMNS = ("id, user_id, patient_id, created_at, file_name, image_sha256, image_width, image_height, "
+                 "image_bytes, label, confidence, predicted, model_fingerprint, backend, processing_ms")
+
+
+class HistoryNotFoundError(LookupError):
+    """Analyse inconnue (ou appartenant à un autre utilisateur)"""
+
+
+def encode_cursor(created_at: float, analysis_id: str) -> str:
+    return base64.urlsafe_b64encode(f"{created_at!r}|{analysis_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """
+    Raises:
+        ValueError: Curseur mal formé
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, analysis_id = raw.split("|", 1)
+        return float(created_at), analysis_id
+    except Exception:
+        raise ValueError("Curseur de pagination invalide")
+
+
+def _image_extension(image_bytes: bytes, file_name: Optional[str]) -> str:
+    header = read_image_size(image_bytes)
+    if header is not None:
+        return "jpg" if header[0] == "jpeg" else header[0]
+    extension = os.path.splitext(file_name or "")[1].lower().lstrip(".")
+    return extension if extension in CONTENT_TYPES else "bin"
+
+
+def make_thumbnail(image_bytes: bytes, max_size: int = HISTORY_THUMBNAIL_SIZE):
+    """
+    Miniature JPEG (côté max `max_size`, jamais agrandie) et dimensions de l'original
+
+    Returns:
+        (octets JPEG, largeur, hauteur), ou (None, None, None) si l'image est illisible
+    """
+    img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None, None, None
+    height, width = img.shape[:2]
+    scale = min(1.0, max_size / max(width, height))
+    if scale < 1.0:
+        img = cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                         interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_JPEG_QUALITY])
+    return (buffer.tobytes() if ok else None), width, height
+
+
+class HistoryStore:
+    """
+    Stockage SQLite + blobs des analyses
+
+    Les images identiques (même SHA-256) partagent un seul fichier et une
+    seule miniature, supprimés quand plus aucune analyse n'y fait référence.
+    """
+
+    def __init__(self, db_path: str = HISTORY_DB, blob_dir: str = HISTORY_BLOB_DIR):
+        self.db_path = db_path
+        self.blob_dir = blob_dir
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        """
+        Connexion ouverte au premier accès (toujours sous self._lock) : importer
+        l'application ne crée ni la base ni le dossier des images
+        """
+        if self._connection is None:
+            self._connection = self._open()
+        return self._connection
+
+    def _open(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_path, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256 TEXT PRIMARY KEY,
+                extension TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                has_thumbnail INTEGER NOT NULL,
+                ref_count INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS analyses (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                patient_id TEXT,
+                created_at REAL NOT NULL,
+                file_name TEXT,
+                image_sha256 TEXT NOT NULL REFERENCES blobs (sha256),
+                image_width INTEGER,
+                image_height INTEGER,
+                image_bytes INTEGER NOT NULL,
+                label TEXT NOT NULL,
+                confidence REAL NOT NULL,
+                predicted INTEGER NOT NULL,
+                model_fingerprint TEXT,
+                backend TEXT,
+                processing_ms REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_analyses_user_created ON analyses (user_id, created_at, id);
+            CREATE INDEX IF NOT EXISTS idx_analyses_created ON analyses (created_at, id);
+            CREATE INDEX IF NOT EXISTS idx_analyses_patient_created ON analyses (patient_id, created_at, id);
+        """)
+        db.commit()
+        return db
+
+    # Blobs
+
+    def _blob_path(self, sha256: str, extension: str) -> str:
+        return os.path.join(self.blob_dir, sha256[:2], sha256[2:4], f"{sha256}.{extension}")
+
+    def _thumbnail_path(self, sha256: str) -> str:
+        return os.path.join(self.blob_dir, "thumbnails", sha256[:2], f"{sha256}.jpg")
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+    def _store_blob(self, image_bytes: bytes, file_name: Optional[str]) -> sqlite3.Row:
+        """Enregistre l'image si elle est nouvelle et incrémente son compteur de références"""
+        sha256 = hashlib.sha256(image_bytes).hexdigest()
+        row = self._db.execute("SELECT * FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is not None:
+            self._db.execute("UPDATE blobs SET ref_count = ref_count + 1 WHERE sha256 = ?", (sha256,))
+            return row
+
+        extension = _image_extension(image_bytes, file_name)
+        thumbnail, width, height = make_thumbnail(image_bytes)
+        self._write_atomic(self._blob_path(sha256, extension), image_bytes)
+        if thumbnail is not None:
+            self._write_atomic(self._thumbnail_path(sha256), thumbnail)
+        self._db.execute(
+            "INSERT INTO blobs (sha256, extension, size, width, height, has_thumbnail, ref_count) "
+            "VALUES (?, ?, ?, ?, ?, ?, 1)",
+            (sha256, extension, len(image_bytes), width, height, int(thumbnail is not None))
+        )
+        return self._db.execute("SELECT * FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+
+    def _release_blob(self, sha256: str):
+        self._db.execute("UPDATE blobs SET ref_count = ref_count - 1 WHERE sha256 = ?", (sha256,))
+        row = self._db.execute("SELECT extension, ref_count FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is not None and row["ref_count"] <= 0:
+            self._db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+            for path in (self._blob_path(sha256, row["extension"]), self._thumbnail_path(sha256)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    # Analyses
+
+    @staticmethod
+    def new_id() -> str:
+        return uuid.uuid4().hex
+
+    def record(self, analysis_id: str, user_id: str, image_bytes: bytes, prediction: dict,
+               file_name: Optional[str] = None, patient_id: Optional[str] = None,
+               model_fingerprint: Optional[str] = None, backend: Optional[str] = None,
+               processing_ms: Optional[float] = None, created_at: Optional[float] = None):
+        """Enregistre une analyse et son image (appel bloquant : à exécuter hors de la boucle)"""
+        with self._lock:
+            try:
+                blob = self._store_blob(image_bytes, file_name)
+                self._db.execute(
+                    f"INSERT INTO analyses ({_LIST_COLUMNS}) VALUES ({', '.join('?' * 15)})",
+                    (analysis_id, user_id, patient_id, created_at or time.time(), file_name, blob["sha256"],
+                     blob["width"], blob["height"], len(image_bytes), prediction["label"],
+                     prediction["confidence"], int(prediction["confidence"] > 0.5), model_fingerprint,
+                     backend, processing_ms)
+                )
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+
+    def _row_to_dict(self, row: sqlite3.Row) -> dict:
+        item = dict(row)
+        item["predicted"] = bool(item["predicted"])
+        scope = urlencode({"user_id": item["user_id"]})
+        item["thumbnail_url"] = f"/history/{item['id']}/thumbnail?{scope}"
+        item["image_url"] = f"/history/{item['id']}/image?{scope}"
+        return item
+
+    def list(self, user_id: str, patient_id: Optional[str] = None,
+             predicted: Optional[bool] = None, since: Optional[float] = None, until: Optional[float] = None,
+             limit: int = HISTORY_PAGE_SIZE, cursor: Optional[str] = None) -> dict:
+        """
+        Page d'analyses d'un utilisateur, de la plus récente à la plus ancienne
+
+        La pagination est par curseur (date, id) : une page ne relit jamais
+        les lignes déjà servies, quel que soit le nombre de pages.
+
+        Raises:
+            ValueError: Curseur invalide
+        """
+        limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+        conditions, parameters = ["user_id = ?"], [user_id]
+        if patient_id is not None:
+            conditions.append("patient_id = ?")
+            parameters.append(patient_id)
+        if predicted is not None:
+            conditions.append("predicted = ?")
+            parameters.append(int(predicted))
+        if since is not None:
+            conditions.append("created_at >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("created_at < ?")
+            parameters.append(until)
+        if cursor:
+            created_at, analysis_id = decode_cursor(cursor)
+            conditions.append("(created_at < ? OR (created_at = ? AND id < ?))")
+            parameters.extend((created_at, created_at, analysis_id))
+
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {_LIST_COLUMNS} FROM analyses WHERE {' AND '.join(conditions)} ORDER BY created_at DESC, id DESC LIMIT ?",
+                (*parameters, limit + 1)
+            ).fetchall()
+
+        items = [self._row_to_dict(row) for row in rows[:limit]]
+        next_cursor = encode_cursor(rows[limit - 1]["created_at"], rows[limit - 1]["id"]) if len(rows) > limit else None
+        return {"items": items, "next_cursor": next_cursor}
+
+    def get(self, analysis_id: str, user_id: str) -> dict:
+        """
+        Raises:
+            HistoryNotFoundError: Analyse inconnue ou appartenant à un autre utilisateur
+        """
+        with self._lock:
+            row = self._db.execute(f"SELECT {_LIST_COLUMNS} FROM analyses WHERE id = ? AND user_id = ?",
+                                   (analysis_id, user_id)).fetchone()
+        if row is None:
+            raise HistoryNotFoundError(f"Analyse introuvable: {analysis_id}")
+        return self._row_to_dict(row)
+
+    def image_file(self, analysis_id: str, user_id: str, thumbnail: bool = False):
+        """
+        Chemin et type MIME de l'image (ou de sa miniature) d'une analyse
+
+        Raises:
+            HistoryNotFoundError: Analyse ou fichier introuvable
+        """
+        item = self.get(analysis_id, user_id)
+        with self._lock:
+            blob = self._db.execute("SELECT * FROM blobs WHERE sha256 = ?", (item["image_sha256"],)).fetchone()
+        if blob is None or (thumbnail and not blob["has_thumbnail"]):
+            raise HistoryNotFoundError(f"Image introuvable pour l'analyse {analysis_id}")
+        if thumbnail:
+            return self._thumbnail_path(blob["sha256"]), "image/jpeg"
+        return (self._blob_path(blob["sha256"], blob["extension"]),
+                CONTENT_TYPES.get(blob["extension"], "application/octet-stream"))
+
+    def delete(self, analysis_id: str, user_id: str):
+        """
+        Raises:
+            HistoryNotFoundError: Analyse inconnue pour cet utilisateur
+        """
+        with self._lock:
+            row = self._db.execute("SELECT image_sha256 FROM analyses WHERE id = ? AND user_id = ?",
+                                   (analysis_id, user_id)).fetchone()
+            if row is None:
+                raise HistoryNotFoundError(f"Analyse introuvable: {analysis_id}")
+            self._db.execute("DELETE FROM analyses WHERE id = ?", (analysis_id,))
+            self._release_blob(row["image_sha256"])
+            self._db.commit()
+
+    def clear_user(self, user_id: str) -> int:
+        """Supprime tout l'historique d'un utilisateur ; renvoie le nombre d'analyses supprimées"""
+        with self._lock:
+            rows = self._db.execute("SELECT image_sha256 FROM analyses WHERE user_id = ?", (user_id,)).fetchall()
+            self._db.execute("DELETE FROM analyses WHERE user_id = ?", (user_id,))
+            for row in rows:
+                self._release_blob(row["image_sha256"])
+            self._db.commit()
+        return len(rows)
+
+    def stats(self) -> dict:
+        with self._lock:
+            analyses = self._db.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+            blobs, blob_bytes = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        return {"analyses": analyses, "unique_images": blobs, "image_bytes": blob_bytes}
@@ -0,0 +1,295 @@
+"""
+Backends d'inférence interchangeables
+Keras (référence), tf.function à signature fixe (optionnellement compilé XLA),
+TFLite float16 et TFLite INT8 (quantification post-entraînement), tous exportés
+depuis les poids existants, avec contrôle de parité par rapport à Keras
+"""
+
+import glob
+import os
+import time
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+
+BACKEND_NAMES = ("keras", "tf_function", "xla", "tflite_fp16", "tflite_int8")
+
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "keras")
+# Dérive maximale de probabilité tolérée par rapport à Keras
+INFERENCE_BACKEND_TOLERANCE = float(os.getenv("INFERENCE_BACKEND_TOLERANCE", "0.02"))
+INFERENCE_BACKEND_CANDIDATES = os.getenv("INFERENCE_BACKEND_CANDIDATES", ",".join(BACKEND_NAMES))
+# Backends dont la latence est à moins de cette fraction du plus rapide : `auto` retient le plus léger
+INFERENCE_BACKEND_LATENCY_MARGIN = float(os.getenv("INFERENCE_BACKEND_LATENCY_MARGIN", "0.1"))
+MODEL_EXPORT_DIR = os.getenv("MODEL_EXPORT_DIR", os.path.join("idc_breast_cancer_model_final", "exports"))
+# Patchs réels pour la calibration INT8 et la parité : par défaut, les dossiers 0/ et 1/ du dépôt
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CALIBRATION_DIR = os.getenv("CALIBRATION_DIR")
+CALIBRATION_DIRS = [CALIBRATION_DIR] if CALIBRATION_DIR else [os.path.join(_REPO_DIR, "0"), os.path.join(_REPO_DIR, "1")]
+CALIBRATION_SAMPLES = int(os.getenv("CALIBRATION_SAMPLES", "64"))
+TFLITE_NUM_THREADS = int(os.getenv("TFLITE_NUM_THREADS", str(os.cpu_count() or 1)))
+
+
+class InferenceBackend:
+    """Interface commune : un batch (N, 50, 50, 3) float32 en entrée, N probabilités en sortie"""
+
+    name = "base"
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def memory_bytes(self) -> int:
+        """Taille approximative des poids en mémoire"""
+        return 0
+
+
+class KerasBackend(InferenceBackend):
+    name = "keras"
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        return np.asarray(self.model(batch, training=False)).reshape(-1)
+
+    def memory_bytes(self) -> int:
+        return int(sum(np.prod(w.shape) * w.dtype.itemsize for w in self.model.get_weights()))
+
+
+class CompiledBackend(KerasBackend):
+    """tf.function à signature fixe : un seul graphe tracé pour toutes les tailles de batch"""
+
+    name = "tf_function"
+
+    def __init__(self, model, jit_compile: bool = False):
+        import tensorflow as tf
+
+        super().__init__(model)
+        self.name = "xla" if jit_compile else "tf_function"
+        input_shape = (None,) + tuple(model.input_shape[1:])
+
+        @tf.function(input_signature=[tf.TensorSpec(input_shape, tf.float32)], jit_compile=jit_compile)
+        def _forward(batch):
+            return model(batch, training=False)
+
+        self._forward = _forward
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        return self._forward(batch).numpy().reshape(-1)
+
+
+class TFLiteBackend(InferenceBackend):
+    """Modèle TFLite exporté une fois puis mis en cache sur disque"""
+
+    def __init__(self, model, quantization: str, fingerprint: Optional[str] = None,
+                 calibration: Optional[np.ndarray] = None):
+        import tensorflow as tf
+
+        if quantization not in ("fp16", "int8"):
+            raise ValueError(f"Quantification TFLite inconnue: {quantization}")
+        self.name = f"tflite_{quantization}"
+
+        export_path = None
+        if fingerprint:
+            export_path = os.path.join(MODEL_EXPORT_DIR, f"model_{quantization}_{fingerprint[:16]}.tflite")
+
+        if export_path and os.path.exists(export_path):
+            with open(export_path, "rb") as f:
+                self.flatbuffer = f.read()
+        else:
+            self.flatbuffer = self._convert(tf, model, quantization, calibration)
+            if export_path:
+                # Fichier temporaire propre au processus puis renommage atomique : les
+                # processus modèle qui exportent en même temps ne lisent jamais un fichier partiel
+                os.makedirs(MODEL_EXPORT_DIR, exist_ok=True)
+                temporary = f"{export_path}.{os.getpid()}.tmp"
+                with open(temporary, "wb") as f:
+                    f.write(self.flatbuffer)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temporary, export_path)
+
+        self.interpreter = tf.lite.Interpreter(model_content=self.flatbuffer, num_threads=TFLITE_NUM_THREADS)
+        self._input_index = self.interpreter.get_input_details()[0]["index"]
+        self._output_index = self.interpreter.get_output_details()[0]["index"]
+        self._batch_size = None
+
+    @staticmethod
+    def _convert(tf, model, quantization: str, calibration: Optional[np.ndarray]) -> bytes:
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+        if quantization == "fp16":
+            converter.target_spec.supported_types = [tf.float16]
+        else:
+            if calibration is None:
+                calibration = load_calibration_samples(model.input_shape[1:], allow_noise=False)
+
+            def representative_dataset():
+                for sample in calibration:
+                    yield [sample[np.newaxis].astype(np.float32)]
+
+            converter.representative_dataset = representative_dataset
+            # Poids et activations en INT8 ; entrée et sortie restent en float32
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+        return converter.convert()
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        # Le graphe n'est réalloué que lorsque la taille de batch change
+        if batch.shape[0] != self._batch_size:
+            self.interpreter.resize_tensor_input(self._input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self._batch_size = batch.shape[0]
+
+        self.interpreter.set_tensor(self._input_index, np.ascontiguousarray(batch, dtype=np.float32))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output_index).reshape(-1).copy()
+
+    def memory_bytes(self) -> int:
+        return len(self.flatbuffer)
+
+
+def load_calibration_samples(input_shape, count: int = CALIBRATION_SAMPLES, allow_noise: bool = True) -> np.ndarray:
+    """
+    Charge des patchs de calibration normalisés depuis CALIBRATION_DIR
+    (par défaut les dossiers 0/ et 1/ du dépôt)
+
+    Les patchs sont pris à intervalles réguliers dans la liste triée, pour
+    couvrir les deux classes. S'il y en a moins que `count`, leurs rotations
+    et retournements complètent l'échantillon. Sans aucun patch réel, un bruit
+    uniforme reproductible est utilisé si `allow_noise`.
+
+    Raises:
+        RuntimeError: Si aucun patch réel n'est trouvé et que le bruit n'est pas accepté
+    """
+    height, width = input_shape[0], input_shape[1]
+    paths = sorted({path for directory in CALIBRATION_DIRS
+                    for path in glob.glob(os.path.join(directory, "**", "*.png"), recursive=True)})
+    if len(paths) > count:
+        paths = [paths[i] for i in np.linspace(0, len(paths) - 1, count).astype(int)]
+
+    samples = []
+    for path in paths:
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is not None:
+            img = cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2RGB), (width, height))
+            samples.append(img.astype(np.float32) / 255.0)
+
+    if not samples:
+        message = f"aucun patch PNG de calibration dans {', '.join(CALIBRATION_DIRS)} (CALIBRATION_DIR)"
+        if not allow_noise:
+            raise RuntimeError(message)
+        print(f"⚠️ {message} : parité mesurée sur données aléatoires")
+        rng = np.random.default_rng(0)
+        return rng.random((count,) + tuple(input_shape), dtype=np.float32)
+
+    variants = [np.rot90(sample, k) for flipped in (False, True) for k in range(4)
+                for sample in ([s[:, ::-1] for s in samples] if flipped else samples)]
+    return np.ascontiguousarray(np.stack(variants[:max(count, len(samples))]))
+
+
+def create_backend(name: str, model, fingerprint: Optional[str] = None,
+                   calibration: Optional[np.ndarray] = None) -> InferenceBackend:
+    """Construit un backend à partir du modèle Keras chargé"""
+    if name == "keras":
+        return KerasBackend(model)
+    if name == "tf_function":
+        return CompiledBackend(model, jit_compile=False)
+    if name == "xla":
+        return CompiledBackend(model, jit_compile=True)
+    if name == "tflite_fp16":
+        return TFLiteBackend(model, "fp16", fingerprint, calibration)
+    if name == "tflite_int8":
+        return TFLiteBackend(model, "int8", fingerprint, calibration)
+    raise ValueError(f"Backend d'inférence inconnu: {name} (valeurs possibles: {', '.join(BACKEND_NAMES)}, auto)")
+
+
+def check_parity(backend: InferenceBackend, reference: InferenceBackend, samples: np.ndarray) -> float:
+    """Dérive maximale de probabilité du backend par rapport à la référence Keras"""
+    expected = reference.predict(samples)
+    actual = backend.predict(samples)
+    return float(np.max(np.abs(expected - actual)))
+
+
+def measure_latency_ms(backend: InferenceBackend, samples: np.ndarray, batch_size: int, repeats: int = 3) -> float:
+    """Latence médiane d'un appel pour une taille de batch donnée (après un appel de chauffe)"""
+    batch = np.resize(samples, (batch_size,) + samples.shape[1:])
+    backend.predict(batch)
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        backend.predict(batch)
+        timings.append((time.perf_counter() - started) * 1000.0)
+    return float(np.median(timings))
+
+
+def select_backend(model, requested: str = INFERENCE_BACKEND, fingerprint: Optional[str] = None,
+                   tolerance: float = INFERENCE_BACKEND_TOLERANCE,
+                   candidates: Optional[List[str]] = None, batch_size: int = 32):
+    """
+    Construit le backend demandé et vérifie sa parité avec Keras
+
+    Avec `requested="auto"`, chaque candidat est mesuré ; parmi ceux dans la
+    tolérance dont la latence est à moins de INFERENCE_BACKEND_LATENCY_MARGIN
+    du plus rapide, le plus léger en mémoire est retenu. Un backend hors
+    tolérance (ou qui ne peut pas être exporté) est remplacé par Keras.
+    `auto` et `tflite_int8` exigent des patchs réels : une dérive mesurée
+    sur du bruit ne dit rien de la dérive sur des lames H&E.
+
+    Returns:
+        (backend retenu, rapport par backend)
+    """
+    reference = KerasBackend(model)
+    if requested == "auto":
+        names = candidates or [name.strip() for name in INFERENCE_BACKEND_CANDIDATES.split(",") if name.strip()]
+    else:
+        names = [requested]
+    # Keras seul et sans mesure de latence : rien à comparer ni à exporter
+    if names == ["keras"] and requested != "auto":
+        samples = None
+    else:
+        try:
+            samples = load_calibration_samples(model.input_shape[1:],
+                                               allow_noise=requested not in ("auto", "tflite_int8"))
+        except RuntimeError as e:
+            print(f"⚠️ Backend '{requested}' impossible à valider ({e}) : repli sur Keras")
+            return reference, {requested: {"available": False, "error": str(e)}}
+
+    report: Dict[str, dict] = {}
+    built = {"keras": reference}
+    for name in names:
+        try:
+            backend = built.get(name) or create_backend(name, model, fingerprint, samples)
+        except ValueError:
+            # Nom de backend inconnu : erreur de configuration
+            raise
+        except Exception as e:
+            report[name] = {"available": False, "error": f"{type(e).__name__}: {e}"}
+            continue
+
+        built[name] = backend
+        drift = 0.0 if backend is reference else check_parity(backend, reference, samples)
+        report[name] = {
+            "available": True,
+            "max_drift": drift,
+            "within_tolerance": drift <= tolerance,
+            "memory_bytes": backend.memory_bytes(),
+        }
+        if requested == "auto":
+            report[name]["latency_ms_batch_1"] = measure_latency_ms(backend, samples, 1)
+            report[name]["latency_ms_batch_%d" % batch_size] = measure_latency_ms(backend, samples, batch_size)
+
+    eligible = [name for name in names if report.get(name, {}).get("within_tolerance")]
+    if requested == "auto" and eligible:
+        latency = lambda name: report[name]["latency_ms_batch_%d" % batch_size]
+        fastest = min(latency(name) for name in eligible)
+        close = [name for name in eligible if latency(name) <= fastest * (1.0 + INFERENCE_BACKEND_LATENCY_MARGIN)]
+        chosen = min(close, key=lambda name: (report[name]["memory_bytes"], latency(name)))
+    elif eligible:
+        chosen = eligible[0]
+    else:
+        print(f"⚠️ Backend '{requested}' indisponible ou hors tolérance ({tolerance}) : repli sur Keras")
+        chosen = "keras"
+
+    return built[chosen], report
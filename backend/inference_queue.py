@@ -0,0 +1,259 @@
+"""
+Ordonnanceur d'inférence par micro-batchs
+Regroupe les requêtes concurrentes de /predict en un seul appel au modèle,
+exécuté hors de la boucle d'événements
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from metrics import INFERENCE_BATCH_SIZE, PREDICT_STAGE
+
+
+class _PendingRequest:
+    """Une image en attente d'inférence et le future de l'appelant"""
+
+    __slots__ = ("sample", "future", "enqueued_at")
+
+    def __init__(self, sample: np.ndarray, future: asyncio.Future):
+        self.sample = sample
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+
+class InferenceScheduler:
+    """
+    Collecte les requêtes en attente et les exécute par batchs
+
+    Un batch part dès qu'il atteint `max_batch_size` images ou que la plus
+    ancienne requête a attendu `max_wait_ms` millisecondes. Au plus
+    `max_concurrent_batches` batchs sont en cours à la fois ; pendant ce
+    temps les requêtes s'accumulent et forment le batch suivant.
+    """
+
+    def __init__(self, predict_fn: Callable[[np.ndarray], np.ndarray],
+                 max_batch_size: int = 32, max_wait_ms: float = 5.0,
+                 max_concurrent_batches: int = 1):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size doit être >= 1")
+        if max_wait_ms < 0:
+            raise ValueError("max_wait_ms doit être >= 0")
+        if max_concurrent_batches < 1:
+            raise ValueError("max_concurrent_batches doit être >= 1")
+
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_concurrent_batches = max_concurrent_batches
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        # Un thread par batch concurrent : avec un seul, le modèle n'est jamais appelé en parallèle
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._batch_slots: Optional[asyncio.Semaphore] = None
+        self._in_flight = set()
+
+        self._batches_total = 0
+        self._samples_total = 0
+        self._errors_total = 0
+        self._max_batch_seen = 0
+        self._batch_size_counts = {}
+        self._wait_ms_total = 0.0
+        self._compute_ms_total = 0.0
+        self._last_batch_size = 0
+        self._last_compute_ms = 0.0
+
+    @classmethod
+    def from_env(cls, predict_fn: Callable[[np.ndarray], np.ndarray],
+                 max_concurrent_batches: int = 1) -> 'InferenceScheduler':
+        """Construit l'ordonnanceur à partir des variables d'environnement"""
+        return cls(
+            predict_fn,
+            max_batch_size=int(os.getenv("INFERENCE_MAX_BATCH_SIZE", "32")),
+            max_wait_ms=float(os.getenv("INFERENCE_MAX_WAIT_MS", "5")),
+            max_concurrent_batches=max_concurrent_batches,
+        )
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None and not self._worker.done()
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._batch_slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent_batches, thread_name_prefix="inference")
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+        # Les requêtes encore en file ne seront jamais servies
+        while self._queue is not None and not self._queue.empty():
+            pending = self._queue.get_nowait()
+            if not pending.future.done():
+                pending.future.set_exception(RuntimeError("Ordonnanceur d'inférence arrêté"))
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def submit(self, sample: np.ndarray) -> float:
+        """
+        Ajoute une image décodée (50, 50, 3) à la file et attend sa probabilité
+
+        Args:
+            sample: Image BGR uint8 décodée et redimensionnée, sans dimension de batch
+
+        Returns:
+            La probabilité IDC prédite pour cette image
+        """
+        if not self.running:
+            raise RuntimeError("Ordonnanceur d'inférence non démarré")
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_PendingRequest(sample, future))
+        return await future
+
+    async def run_batch(self, samples: np.ndarray) -> np.ndarray:
+        """
+        Exécute directement un batch déjà constitué sur le thread du modèle
+
+        Utilisé par les requêtes en masse : le batch ne passe pas par la file,
+        mais partage le même thread que les micro-batchs de /predict.
+
+        Args:
+            samples: Images BGR uint8 décodées (N, 50, 50, 3)
+
+        Returns:
+            Les N probabilités prédites
+        """
+        if not self.running:
+            raise RuntimeError("Ordonnanceur d'inférence non démarré")
+
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            probas = await loop.run_in_executor(self._executor, self.predict_fn, samples)
+        except Exception:
+            self._errors_total += 1
+            raise
+
+        self._record_batch(len(samples), (time.perf_counter() - started) * 1000.0)
+        return probas
+
+    async def _collect_batch(self) -> List[_PendingRequest]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait_ms / 1000.0
+
+        while len(batch) < self.max_batch_size:
+            # Vider d'abord ce qui est déjà en file, sans attendre
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self):
+        while True:
+            # Attendre une place libre avant de collecter : pendant qu'un batch
+            # s'exécute, les requêtes s'accumulent pour le suivant
+            await self._batch_slots.acquire()
+            try:
+                batch = await self._collect_batch()
+            except BaseException:
+                self._batch_slots.release()
+                raise
+
+            # Ignorer les appelants qui ont abandonné (client déconnecté)
+            batch = [pending for pending in batch if not pending.future.done()]
+            if not batch:
+                self._batch_slots.release()
+                continue
+
+            task = asyncio.create_task(self._execute(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _execute(self, batch: List[_PendingRequest]):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            samples = np.stack([pending.sample for pending in batch])
+            probas = await loop.run_in_executor(self._executor, self.predict_fn, samples)
+        except Exception as e:
+            self._errors_total += 1
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+            return
+        finally:
+            self._batch_slots.release()
+
+        waits = [started - pending.enqueued_at for pending in batch]
+        for wait_s in waits:
+            PREDICT_STAGE.observe(wait_s, stage="queue_wait")
+        wait_ms = sum(waits) * 1000.0
+        self._record_batch(len(batch), (time.perf_counter() - started) * 1000.0, wait_ms)
+
+        for pending, proba in zip(batch, probas):
+            if not pending.future.done():
+                pending.future.set_result(float(proba))
+
+    def _record_batch(self, size: int, compute_ms: float, wait_ms: float = 0.0):
+        PREDICT_STAGE.observe(compute_ms / 1000.0, stage="batch")
+        INFERENCE_BATCH_SIZE.observe(size)
+        self._batches_total += 1
+        self._samples_total += size
+        self._max_batch_seen = max(self._max_batch_seen, size)
+        self._batch_size_counts[size] = self._batch_size_counts.get(size, 0) + 1
+        self._wait_ms_total += wait_ms
+        self._compute_ms_total += compute_ms
+        self._last_batch_size = size
+        self._last_compute_ms = compute_ms
+
+    def stats(self) -> dict:
+        """Profondeur de file et statistiques sur la taille des batchs"""
+        batches = self._batches_total
+        samples = self._samples_total
+        return {
+            "running": self.running,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_ms,
+            "max_concurrent_batches": self.max_concurrent_batches,
+            "batches_in_flight": len(self._in_flight),
+            "batches_total": batches,
+            "samples_total": samples,
+            "errors_total": self._errors_total,
+            "mean_batch_size": samples / batches if batches else 0.0,
+            "max_batch_size_seen": self._max_batch_seen,
+            "last_batch_size": self._last_batch_size,
+            "batch_size_histogram": {str(size): count for size, count in sorted(self._batch_size_counts.items())},
+            "mean_queue_wait_ms": self._wait_ms_total / samples if samples else 0.0,
+            "mean_batch_compute_ms": self._compute_ms_total / batches if batches else 0.0,
+            "last_batch_compute_ms": self._last_compute_ms,
+        }
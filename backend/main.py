@@ -1,17 +1,104 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+from fastapi import BackgroundTasks, FastAPI, UploadFile, File, Form, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from typing import Optional, List
-from script import predict_from_bytes
-from flashcard_service import generate_flashcards, FlashCard, FlashCardConfig
+from script import predict_batch, format_prediction, model_loader
+from preprocessing import MAX_UPLOAD_BYTES, ImageRejectedError, decode_image, run_in_decode_pool
+from model_loader import LOAD_MODES, MODEL_LOAD_MODE, ModelNotReadyError
+from prediction_cache import PredictionCache
+from inference_queue import InferenceScheduler
+from model_workers import ModelWorkerPool
+from cascade import INFERENCE_CASCADE, STAGE_TEACHER, InferenceCascade, StudentModel
+from metrics import (REGISTRY, CASCADE_ESCALATION_RATIO, INFERENCE_BATCHES_IN_FLIGHT, INFERENCE_QUEUE_DEPTH,
+                     PREDICT_STAGE, MetricsMiddleware)
+from profiler import SlowRequestProfiler
+from batch_predict import read_batch_uploads, stream_batch_predictions
+from tiling import TILE_SIZE, score_large_image
+from flashcard_service import FlashCard, FlashCardConfig
+from flashcard_providers import FlashcardGenerator, FlashcardRateLimitError
+from history_store import HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE, HistoryNotFoundError, HistoryStore
+
+# inprocess : le modèle tourne dans ce processus
+# workers : pool de processus modèle alimenté par mémoire partagée
+SERVING_MODES = ("inprocess", "workers")
+SERVING_MODE = os.getenv("SERVING_MODE", "inprocess")
+if SERVING_MODE not in SERVING_MODES:
+    raise ValueError(f"SERVING_MODE invalide: {SERVING_MODE} (valeurs possibles: {', '.join(SERVING_MODES)})")
+
+# Regroupe les requêtes concurrentes de /predict en batchs
+# En mode workers, le pool est exclusif (MODEL_WORKER_POOL_NAME) : un second processus HTTP refuse de démarrer
+if SERVING_MODE == "workers":
+    worker_pool = ModelWorkerPool()
+    scheduler = InferenceScheduler.from_env(worker_pool.predict, max_concurrent_batches=worker_pool.num_workers)
+    model_status = worker_pool.status
+    loaded_fingerprint = lambda: worker_pool.fingerprint
+else:
+    worker_pool = None
+    scheduler = InferenceScheduler.from_env(predict_batch)
+    model_status = model_loader.status
+    loaded_fingerprint = lambda: model_loader.fingerprint
+
+# Cascade : un premier étage léger tranche, ResNet50 ne voit que les patchs incertains
+if INFERENCE_CASCADE:
+    student_model = StudentModel()
+    cascade = InferenceCascade(student_model, InferenceScheduler.from_env(student_model.predict), scheduler)
+    CASCADE_ESCALATION_RATIO.set_function(cascade.escalation_rate)
+else:
+    cascade = None
+
+INFERENCE_QUEUE_DEPTH.set_function(lambda: scheduler.stats()["queue_depth"])
+INFERENCE_BATCHES_IN_FLIGHT.set_function(lambda: scheduler.stats()["batches_in_flight"])
+
+# Piles des requêtes les plus lentes (PROFILE_SLOWEST_N > 0)
+profiler = SlowRequestProfiler()
+
+# Client Gemini partagé, cache des réponses et limitation de débit
+flashcard_generator = FlashcardGenerator()
+
+# Cache adressé par contenu : pixels 50x50 décodés + empreinte des poids chargés
+prediction_cache = PredictionCache(loaded_fingerprint, model_loader.weights_path)
+
+# Historique des analyses : SQLite + images adressées par contenu, ouverts au premier usage
+history_store = HistoryStore()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if MODEL_LOAD_MODE not in LOAD_MODES:
+        raise ValueError(f"MODEL_LOAD_MODE invalide: {MODEL_LOAD_MODE} (valeurs possibles: {', '.join(LOAD_MODES)})")
+    if worker_pool is not None:
+        worker_pool.start()
+    elif MODEL_LOAD_MODE == "background":
+        model_loader.start_background()
+    elif MODEL_LOAD_MODE == "eager":
+        await run_in_threadpool(model_loader.load)
+    await scheduler.start()
+    if cascade is not None:
+        await cascade.start()
+    yield
+    if cascade is not None:
+        await cascade.stop()
+    await scheduler.stop()
+    if worker_pool is not None:
+        await run_in_threadpool(worker_pool.stop)
+
 
 app = FastAPI(
     title="Breast Cancer API",
     description="API de prédiction IDC avec ResNet50",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 
+app.add_middleware(MetricsMiddleware, profiler=profiler)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:4200"],  
@@ -20,17 +107,171 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(ModelNotReadyError)
+async def model_not_ready_handler(request, exc: ModelNotReadyError):
+    return JSONResponse(status_code=503, content={"detail": f"Modèle indisponible: {exc}"})
+
+
+@app.exception_handler(ImageRejectedError)
+async def image_rejected_handler(request, exc: ImageRejectedError):
+    return JSONResponse(status_code=exc.status_code, content={"detail": str(exc)})
+
+
 @app.post("/predict")
-async def predict_image(file: UploadFile = File(...)):
-    image_bytes = await file.read()
-    result = predict_from_bytes(image_bytes)
-    return  result
-    
+async def predict_image(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    user_id: Optional[str] = Form(default=None, description="Si fourni, l'analyse est ajoutée à l'historique"),
+    patient_id: Optional[str] = Form(default=None)
+):
+    started = time.perf_counter()
+    # Lire au plus une limite + 1 octet suffit pour refuser un fichier trop gros
+    with PREDICT_STAGE.time(stage="read_upload"):
+        image_bytes = await file.read(MAX_UPLOAD_BYTES + 1)
+    img, cache_key, proba = await run_in_decode_pool(_decode_and_lookup, image_bytes)
+    # Le cache ne contient que des probabilités ResNet50
+    stage = STAGE_TEACHER
+    if proba is None:
+        if cascade is not None:
+            proba, stage = await cascade.submit(img)
+        else:
+            proba = await scheduler.submit(img)
+        if stage == STAGE_TEACHER:
+            await run_in_threadpool(prediction_cache.put, cache_key, proba)
+    prediction = format_prediction(proba)
+    if cascade is not None:
+        prediction["stage"] = stage
+
+    if user_id:
+        # Enregistré après l'envoi de la réponse : l'historique n'ajoute pas de latence
+        prediction["analysis_id"] = analysis_id = HistoryStore.new_id()
+        background_tasks.add_task(
+            _record_analysis, analysis_id, user_id, image_bytes, dict(prediction), file.filename, patient_id,
+            (time.perf_counter() - started) * 1000.0
+        )
+    return prediction
+
+
+def _record_analysis(analysis_id, user_id, image_bytes, prediction, file_name, patient_id, processing_ms):
+    try:
+        history_store.record(
+            analysis_id, user_id, image_bytes, prediction, file_name=file_name, patient_id=patient_id,
+            model_fingerprint=loaded_fingerprint(), backend=model_status()["backend"], processing_ms=processing_ms
+        )
+    except Exception as e:
+        print(f"⚠️ Analyse {analysis_id} non enregistrée dans l'historique: {e}")
+
+
+def _decode_and_lookup(image_bytes: bytes):
+    img = decode_image(image_bytes)
+    with PREDICT_STAGE.time(stage="cache_lookup"):
+        cache_key = prediction_cache.make_key(img)
+        proba = prediction_cache.get(cache_key)
+    return img, cache_key, proba
+
+
+@app.post("/predict/batch")
+async def predict_images_batch(files: List[UploadFile] = File(...)):
+    """
+    Prédit plusieurs patchs en une seule requête
+    Accepte plusieurs images ou une archive zip/tar, renvoie une ligne JSON par image (NDJSON)
+    """
+    try:
+        items = await read_batch_uploads(files)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if not items:
+        raise HTTPException(status_code=400, detail="Aucune image trouvée dans la requête")
+
+    # Une fois le flux commencé, le statut 200 est envoyé : un échec de chargement doit être signalé avant
+    status = model_status()
+    if status["status"] == "failed":
+        raise ModelNotReadyError(status["error"])
+
+    return StreamingResponse(
+        stream_batch_predictions(items, scheduler, cascade=cascade),
+        media_type="application/x-ndjson"
+    )
+
+
+@app.post("/predict/tiles")
+async def predict_large_image(
+    file: UploadFile = File(...),
+    stride: int = Query(default=TILE_SIZE, ge=1, description="Pas en pixels entre deux tuiles 50x50")
+):
+    """
+    Prédiction sur une grande image histopathologique par tuilage
+    Renvoie un score agrégé sur les tuiles de tissu et une carte de chaleur des probabilités
+    """
+    try:
+        # Fichier de l'upload lu directement : une TIFF n'est jamais chargée entière en mémoire
+        return await score_large_image(file.file, scheduler, stride=stride)
+    except ImageRejectedError:
+        # 413 / 400 portés par l'exception (gestionnaire dédié)
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/inference/stats")
+def inference_stats():
+    """Profondeur de la file d'inférence et statistiques des batchs"""
+    return scheduler.stats()
+
+
+@app.get("/inference/cascade")
+def cascade_stats():
+    """Bande d'incertitude, décisions par étage et taux d'escalade vers ResNet50"""
+    if cascade is None:
+        raise HTTPException(status_code=404, detail="Cascade désactivée (INFERENCE_CASCADE=0)")
+    return cascade.stats()
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    """Compteurs hits/misses et taille du cache des prédictions"""
+    return prediction_cache.stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Métriques au format texte Prometheus"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/debug/profiles")
+def slowest_profiles():
+    """Piles échantillonnées (format folded) des requêtes les plus lentes"""
+    if not profiler.enabled:
+        raise HTTPException(status_code=404, detail="Profileur désactivé (PROFILE_SLOWEST_N=0)")
+    return profiler.slowest()
+
+
+@app.get("/inference/backend")
+def inference_backend():
+    """Backend d'inférence retenu et rapport de parité (dérive maximale par rapport à Keras)"""
+    status = model_status()
+    return {"backend": status["backend"], "report": status["backend_report"]}
+
 
 @app.get("/")
 def home():
     return {"message": "IDC Breast Cancer Prediction API is running "}
 
+
+@app.get("/health/live")
+def liveness():
+    """Le processus répond (indépendamment de l'état du modèle)"""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+def readiness():
+    """Le modèle est chargé et prêt ; 503 sinon, avec la durée de chaque phase de démarrage"""
+    status = model_status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
 # Modèle pour les requêtes de génération de flashcards
 class FlashCardRequest(BaseModel):
     text: str = Field(..., description="Le texte source pour générer les flashcards")
@@ -48,21 +289,14 @@ async def generate_flashcards_endpoint(request: FlashCardRequest):
     """
     Endpoint pour générer des flashcards à partir d'un texte
     Utilise Google Gemini API (gratuit, 60 requêtes par minute)
+    ou le fournisseur local (FLASHCARD_PROVIDER=stub)
     """
     try:
         # Créer la configuration
-        config = FlashCardConfig()
-        if request.max_question_words:
-            config.set_max_question_words(request.max_question_words)
-        if request.max_answer_words:
-            config.set_max_answer_words(request.max_answer_words)
-        if request.number_of_cards:
-            config.set_number_of_cards(request.number_of_cards)
-        if request.temperature is not None:
-            config.set_temperature(request.temperature)
+        config = _flashcard_config(request)
         
-        # Générer les flashcards
-        flash_cards = generate_flashcards(request.text, config)
+        # Générer les flashcards (sans bloquer la boucle d'événements)
+        flash_cards = await flashcard_generator.generate(request.text, config)
         
         # Convertir en format JSON
         flashcards_data = [card.to_dict() for card in flash_cards]
@@ -72,6 +306,9 @@ async def generate_flashcards_endpoint(request: FlashCardRequest):
             total=len(flashcards_data)
         )
         
+    except FlashcardRateLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e),
+                            headers={"Retry-After": str(int(e.retry_after_s) + 1)})
     except ValueError as e:
         # Erreur de configuration ou de parsing
         raise HTTPException(status_code=400, detail=str(e))
@@ -80,3 +317,107 @@ async def generate_flashcards_endpoint(request: FlashCardRequest):
         error_msg = str(e)
         print(f"Erreur dans /flashcards: {error_msg}")
         raise HTTPException(status_code=500, detail=f"Erreur lors de la génération des flashcards: {error_msg}")
+
+
+def _flashcard_config(request: FlashCardRequest) -> FlashCardConfig:
+    config = FlashCardConfig()
+    if request.max_question_words:
+        config.set_max_question_words(request.max_question_words)
+    if request.max_answer_words:
+        config.set_max_answer_words(request.max_answer_words)
+    if request.number_of_cards:
+        config.set_number_of_cards(request.number_of_cards)
+    if request.temperature is not None:
+        config.set_temperature(request.temperature)
+    return config
+
+
+@app.post("/flashcards/stream")
+async def stream_flashcards_endpoint(request: FlashCardRequest):
+    """
+    Mode documents longs : le texte est découpé en morceaux générés en parallèle
+    Renvoie une ligne JSON par flashcard dès qu'elle est extraite (NDJSON), puis un résumé
+    """
+    if not request.text.strip():
+        raise HTTPException(status_code=400, detail="Le texte est vide")
+
+    async def _lines():
+        async for event in flashcard_generator.stream(request.text, _flashcard_config(request)):
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(_lines(), media_type="application/x-ndjson")
+
+
+@app.get("/flashcards/stats")
+def flashcard_stats():
+    """Fournisseur actif, cache des réponses et limitation de débit"""
+    return flashcard_generator.stats()
+
+
+@app.get("/history")
+def list_history(
+    user_id: str,
+    patient_id: Optional[str] = None,
+    predicted: Optional[bool] = Query(default=None, description="true : IDC positif, false : négatif"),
+    since: Optional[float] = Query(default=None, description="Horodatage Unix minimal (inclus)"),
+    until: Optional[float] = Query(default=None, description="Horodatage Unix maximal (exclu)"),
+    limit: int = Query(default=HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(default=None, description="next_cursor de la page précédente")
+):
+    """
+    Analyses d'un utilisateur, de la plus récente à la plus ancienne, sans les images
+    Chaque ligne porte les URL de sa miniature et de l'image d'origine
+    """
+    try:
+        return history_store.list(user_id=user_id, patient_id=patient_id, predicted=predicted,
+                                  since=since, until=until, limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/history/stats")
+def history_stats():
+    """Nombre d'analyses, d'images distinctes et volume stocké"""
+    return history_store.stats()
+
+
+@app.get("/history/{analysis_id}")
+def get_history_entry(analysis_id: str, user_id: str):
+    try:
+        return history_store.get(analysis_id, user_id)
+    except HistoryNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@app.get("/history/{analysis_id}/thumbnail")
+def get_history_thumbnail(analysis_id: str, user_id: str):
+    return _history_file(analysis_id, user_id, thumbnail=True)
+
+
+@app.get("/history/{analysis_id}/image")
+def get_history_image(analysis_id: str, user_id: str):
+    return _history_file(analysis_id, user_id, thumbnail=False)
+
+
+def _history_file(analysis_id: str, user_id: str, thumbnail: bool):
+    try:
+        path, media_type = history_store.image_file(analysis_id, user_id, thumbnail=thumbnail)
+    except HistoryNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    # Contenu immuable : l'URL désigne toujours la même image
+    return FileResponse(path, media_type=media_type, headers={"Cache-Control": "private, max-age=31536000, immutable"})
+
+
+@app.delete("/history/{analysis_id}")
+def delete_history_entry(analysis_id: str, user_id: str):
+    try:
+        history_store.delete(analysis_id, user_id)
+    except HistoryNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"deleted": 1}
+
+
+@app.delete("/history")
+def clear_history(user_id: str):
+    """Supprime tout l'historique d'un utilisateur"""
+    return {"deleted": history_store.clear_user(user_id)}
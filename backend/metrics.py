@@ -0,0 +1,261 @@
+"""
+Métriques de l'application au format texte Prometheus
+Compteurs, jauges et histogrammes sans dépendance externe, durées par
+étape du chemin d'inférence et des flashcards, et middleware HTTP
+"""
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+# Durées en secondes, de la milliseconde à la minute
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Tailles (octets, pixels, caractères) : puissances de 4
+SIZE_BUCKETS = tuple(4.0 ** exponent for exponent in range(3, 15))
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class MetricsRegistry:
+    """Ensemble des métriques exposées par /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        """Exposition au format texte Prometheus 0.0.4"""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional[MetricsRegistry] = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: labels attendus {self.labelnames}, reçus {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Valeur cumulée, uniquement croissante"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """Valeur instantanée ; peut être lue à la demande via set_function"""
+
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float]):
+        """La valeur est calculée au moment du rendu (métrique sans label)"""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            try:
+                return [f"{self.name} {_format_value(float(self._function()))}"]
+            except Exception:
+                return []
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    """Distribution par seaux cumulés, avec somme et nombre d'observations"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry: Optional[MetricsRegistry] = REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [compte par seau (+Inf en dernier), somme, nombre]
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe la durée (en secondes) du bloc"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, ([*state[0]], state[1], state[2])) for key, state in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames + ("le",), key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+# HTTP
+HTTP_REQUESTS = Counter("http_requests_total", "Requêtes HTTP traitées", ("endpoint", "status"))
+HTTP_DURATION = Histogram("http_request_duration_seconds", "Durée des requêtes HTTP, corps de réponse inclus",
+                          ("endpoint",))
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "Requêtes HTTP en cours")
+
+# Chemin d'inférence
+PREDICT_STAGE = Histogram(
+    "predict_stage_seconds",
+    "Durée de chaque étape de prédiction (read_upload, imdecode, resize, cache_lookup, queue_wait, "
+    "batch, normalize, model, student_model)",
+    ("stage",),
+)
+INFERENCE_BATCH_SIZE = Histogram("inference_batch_size", "Images par appel au modèle", buckets=BATCH_SIZE_BUCKETS)
+INFERENCE_QUEUE_DEPTH = Gauge("inference_queue_depth", "Requêtes /predict en attente d'un batch")
+INFERENCE_BATCHES_IN_FLIGHT = Gauge("inference_batches_in_flight", "Batchs en cours d'exécution")
+
+# Cascade (INFERENCE_CASCADE=1)
+CASCADE_DECISIONS = Counter("inference_cascade_decisions_total",
+                            "Patchs tranchés par étage de la cascade (student, resnet50)", ("stage",))
+CASCADE_ESCALATION_RATIO = Gauge("inference_cascade_escalation_ratio",
+                                 "Part des patchs transmis à ResNet50 depuis le démarrage")
+
+# Entrées
+INPUT_UPLOAD_BYTES = Histogram("input_upload_bytes", "Taille des images reçues (octets)", buckets=SIZE_BUCKETS)
+INPUT_IMAGE_PIXELS = Histogram("input_image_pixels", "Nombre de pixels des images source", buckets=SIZE_BUCKETS)
+INPUT_IMAGE_SIDE = Histogram("input_image_side_pixels", "Largeur et hauteur des images source", ("axis",),
+                             buckets=(50, 100, 200, 400, 800, 1600, 3200, 6400, 12800))
+
+# Flashcards
+FLASHCARD_STAGE = Histogram(
+    "flashcard_stage_seconds",
+    "Durée de chaque étape de génération de flashcards (rate_limit_wait, provider, parse, first_card, total)",
+    ("stage",),
+)
+FLASHCARD_INPUT_CHARS = Histogram("flashcard_input_chars", "Taille des textes sources (caractères)",
+                                  buckets=SIZE_BUCKETS)
+FLASHCARD_CALLS_IN_FLIGHT = Gauge("flashcard_provider_calls_in_flight", "Appels au fournisseur de flashcards en cours")
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI : requêtes en cours, durée et statut par endpoint
+
+    La durée court jusqu'au dernier fragment du corps, réponses en flux
+    comprises. L'endpoint est le nom de la fonction de route (pas le
+    chemin brut, pour borner le nombre de séries).
+    """
+
+    def __init__(self, app, profiler=None):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = {"code": 500}
+        profile = self.profiler.begin() if self.profiler is not None else None
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            duration = time.perf_counter() - started
+            endpoint = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            HTTP_REQUESTS.inc(endpoint=endpoint, status=status["code"])
+            HTTP_DURATION.observe(duration, endpoint=endpoint)
+            if profile is not None:
+                self.profiler.end(profile, endpoint, scope.get("path", ""), duration)
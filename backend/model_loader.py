@@ -0,0 +1,191 @@
+"""
+Chargement du modèle IDC
+Reconstruit le réseau depuis la configuration Keras déjà livrée (sans
+téléchargement des poids ImageNet), charge les poids entraînés et fait
+un passage de chauffe, en arrière-plan ou au premier usage
+"""
+
+import hashlib
+import os
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+MODEL_DIR = os.getenv("MODEL_DIR", "idc_breast_cancer_model_final")
+MODEL_CONFIG_PATH = os.getenv("MODEL_CONFIG_PATH", os.path.join(MODEL_DIR, "config.json"))
+MODEL_WEIGHTS_PATH = os.getenv("MODEL_WEIGHTS_PATH", os.path.join(MODEL_DIR, "model.weights.h5"))
+
+# background : chargement dans un thread au démarrage de l'API
+# eager : le démarrage attend la fin du chargement
+# lazy : chargement à la première prédiction
+LOAD_MODES = ("background", "eager", "lazy")
+MODEL_LOAD_MODE = os.getenv("MODEL_LOAD_MODE", "background")
+# Benchmarks hors ligne : sans fichier de poids, modèle create_model initialisé
+# aléatoirement (prédictions sans valeur, coût de calcul identique)
+MODEL_ALLOW_RANDOM_INIT = os.getenv("MODEL_ALLOW_RANDOM_INIT", "0") == "1"
+RANDOM_INIT_FINGERPRINT = "random-init"
+RANDOM_INIT_SEED = 0
+
+
+class ModelNotReadyError(RuntimeError):
+    """Le modèle n'est pas (encore) disponible pour l'inférence"""
+
+
+def weights_fingerprint(path: str) -> str:
+    """Empreinte SHA-256 du fichier de poids"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ModelLoader:
+    """Charge le modèle une seule fois et mesure chaque phase du démarrage"""
+
+    def __init__(self, config_path: str = MODEL_CONFIG_PATH, weights_path: str = MODEL_WEIGHTS_PATH,
+                 input_shape=(50, 50, 3), allow_random_init: bool = MODEL_ALLOW_RANDOM_INIT):
+        self.config_path = config_path
+        self.weights_path = weights_path
+        self.input_shape = input_shape
+        self.allow_random_init = allow_random_init
+
+        self.state = "pending"
+        self.error: Optional[str] = None
+        self.phases_ms = {}
+        self.fingerprint: Optional[str] = None
+        self.backend_report = {}
+        self._model = None
+        self._backend = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._model is not None
+
+    def start_background(self):
+        """Lance le chargement dans un thread démon (sans effet s'il est déjà lancé)"""
+        if self._thread is not None or self.ready:
+            return
+        self._thread = threading.Thread(target=self._load_quietly, name="model-loader", daemon=True)
+        self._thread.start()
+
+    def _load_quietly(self):
+        try:
+            self.load()
+        except ModelNotReadyError:
+            # L'erreur est conservée dans self.error et exposée par /health/ready
+            pass
+
+    def _timed(self, phase: str, fn, *args):
+        started = time.perf_counter()
+        result = fn(*args)
+        self.phases_ms[phase] = round((time.perf_counter() - started) * 1000.0, 1)
+        return result
+
+    def load(self):
+        """
+        Charge le modèle (idempotent, thread-safe)
+
+        Returns:
+            Le modèle Keras prêt pour l'inférence
+
+        Raises:
+            ModelNotReadyError: Si la configuration ou les poids sont introuvables ou invalides
+        """
+        with self._lock:
+            if self._model is not None:
+                return self._model
+            if self.state == "failed":
+                raise ModelNotReadyError(self.error)
+
+            self.state = "loading"
+            started = time.perf_counter()
+            try:
+                keras = self._timed("import_tensorflow", self._import_keras)
+                if self.allow_random_init and not os.path.exists(self.weights_path):
+                    model = self._timed("build_random_init", self._build_random_init, keras)
+                    self.fingerprint = RANDOM_INIT_FINGERPRINT
+                else:
+                    model = self._timed("build_from_config", self._build, keras)
+                    self._timed("load_weights", self._load_weights, model)
+                    self.fingerprint = self._timed("fingerprint", weights_fingerprint, self.weights_path)
+                self._timed("warmup", self._warmup, model)
+                backend = self._timed("select_backend", self._select_backend, model)
+            except Exception as e:
+                self.state = "failed"
+                self.error = f"{type(e).__name__}: {e}"
+                print(f"⚠️ Échec du chargement du modèle: {self.error}")
+                raise ModelNotReadyError(self.error) from e
+
+            self.phases_ms["total"] = round((time.perf_counter() - started) * 1000.0, 1)
+            self._backend = backend
+            self._model = model
+            self.state = "ready"
+            print(f"Modèle chargé avec succès ({self.phases_ms['total']:.0f} ms, backend {backend.name})")
+            return model
+
+    def get_model(self):
+        """Renvoie le modèle, en le chargeant au besoin (attend un chargement en cours)"""
+        if self._model is not None:
+            return self._model
+        return self.load()
+
+    def get_backend(self):
+        """Renvoie le backend d'inférence retenu, en chargeant le modèle au besoin"""
+        if self._backend is None:
+            self.load()
+        return self._backend
+
+    @staticmethod
+    def _import_keras():
+        from tensorflow import keras
+        return keras
+
+    def _build(self, keras):
+        if not os.path.exists(self.config_path):
+            raise FileNotFoundError(f"Configuration du modèle introuvable: {self.config_path}")
+        with open(self.config_path, "r", encoding="utf-8") as f:
+            model = keras.models.model_from_json(f.read())
+        # config.json déclare ses entrées sous forme de liste : on expose une
+        # entrée unique, comme le modèle construit par create_model
+        return keras.Model(inputs=model.inputs[0], outputs=model.outputs[0])
+
+    def _build_random_init(self, keras):
+        from script import create_model
+
+        print(f"⚠️ Poids introuvables ({self.weights_path}) : modèle initialisé aléatoirement")
+        keras.utils.set_random_seed(RANDOM_INIT_SEED)
+        return create_model(input_shape=self.input_shape, weights=None)
+
+    def _load_weights(self, model):
+        if not os.path.exists(self.weights_path):
+            raise FileNotFoundError(f"Poids du modèle introuvables: {self.weights_path}")
+        model.load_weights(self.weights_path)
+
+    def _warmup(self, model):
+        model(np.zeros((1,) + tuple(self.input_shape), dtype=np.float32), training=False)
+
+    def _select_backend(self, model):
+        from inference_backends import select_backend
+
+        backend, self.backend_report = select_backend(model, fingerprint=self.fingerprint)
+        backend.predict(np.zeros((1,) + tuple(self.input_shape), dtype=np.float32))
+        return backend
+
+    def status(self) -> dict:
+        return {
+            "status": self.state,
+            "ready": self.ready,
+            "error": self.error,
+            "load_mode": MODEL_LOAD_MODE,
+            "config_path": self.config_path,
+            "weights_path": self.weights_path,
+            "weights_fingerprint": self.fingerprint,
+            "backend": self._backend.name if self._backend is not None else None,
+            "backend_report": self.backend_report,
+            "phases_ms": dict(self.phases_ms),
+        }
@@ -0,0 +1,406 @@
+"""
+Service du modèle par un pool fixe de processus
+Chaque processus charge son propre modèle avec un budget de threads fixe ;
+les images (uint8) et les probabilités transitent par un anneau de slots
+en mémoire partagée, seuls des indices de slot passent par les files
+"""
+
+import multiprocessing as mp
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+from typing import List, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows : la mémoire partagée disparaît avec le processus qui l'a créée
+    fcntl = None
+
+from model_loader import MODEL_WEIGHTS_PATH, ModelNotReadyError
+from preprocessing import IMG_SIZE
+
+MODEL_WORKERS = int(os.getenv("MODEL_WORKERS", "2"))
+MODEL_WORKER_THREADS = int(os.getenv("MODEL_WORKER_THREADS", str(max(1, (os.cpu_count() or 1) // MODEL_WORKERS))))
+# Épingle chaque processus sur son propre bloc de cœurs (Linux uniquement)
+MODEL_WORKER_PIN_CPUS = os.getenv("MODEL_WORKER_PIN_CPUS", "0") == "1"
+# Nombre maximal d'images par slot ; les batchs plus grands sont découpés entre les processus
+MODEL_WORKER_SLOT_CAPACITY = int(os.getenv("MODEL_WORKER_SLOT_CAPACITY", "256"))
+MODEL_WORKER_TIMEOUT_S = float(os.getenv("MODEL_WORKER_TIMEOUT_S", "120"))
+# Nom fixe de la mémoire partagée : un seul pool par machine et par nom
+MODEL_WORKER_POOL_NAME = os.getenv("MODEL_WORKER_POOL_NAME", "idc_model_pool")
+# Intervalle de vérification des processus pendant une attente
+WORKER_POLL_S = 0.5
+
+SAMPLE_SHAPE = (IMG_SIZE[1], IMG_SIZE[0], 3)
+
+
+def _cpu_block(worker_id: int, threads: int) -> Optional[List[int]]:
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    start = (worker_id * threads) % len(cpus)
+    return [cpus[(start + offset) % len(cpus)] for offset in range(min(threads, len(cpus)))]
+
+
+def _unlink_stale_segment(name: str):
+    """Supprime un segment laissé par un pool arrêté brutalement"""
+    try:
+        stale = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    stale.close()
+    stale.unlink()
+
+
+def _worker_main(worker_id: int, input_name: str, output_name: str, num_slots: int, capacity: int,
+                 threads: int, cpus: Optional[List[int]], tasks, results):
+    """Boucle d'un processus modèle : lit un slot, prédit, écrit les probabilités dans le slot"""
+    # Le budget de threads doit être fixé avant l'import de TensorFlow
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["TFLITE_NUM_THREADS"] = str(threads)
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+    from model_loader import ModelLoader
+    from preprocessing import to_model_input
+
+    input_shm = shared_memory.SharedMemory(name=input_name)
+    output_shm = shared_memory.SharedMemory(name=output_name)
+    inputs = np.ndarray((num_slots, capacity) + SAMPLE_SHAPE, dtype=np.uint8, buffer=input_shm.buf)
+    outputs = np.ndarray((num_slots, capacity), dtype=np.float32, buffer=output_shm.buf)
+
+    try:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+        loader = ModelLoader()
+        backend = loader.get_backend()
+    except Exception as e:
+        results.put(("failed", worker_id, f"{type(e).__name__}: {e}"))
+        return
+
+    status = loader.status()
+    results.put(("ready", worker_id, {
+        "pid": os.getpid(),
+        "threads": threads,
+        "cpus": cpus,
+        "backend": status["backend"],
+        "backend_report": status["backend_report"],
+        "weights_fingerprint": status["weights_fingerprint"],
+        "phases_ms": status["phases_ms"],
+    }))
+
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            slot, count = task
+            try:
+                outputs[slot, :count] = backend.predict(to_model_input(inputs[slot, :count]))
+                results.put(("done", slot, None))
+            except Exception as e:
+                results.put(("done", slot, f"{type(e).__name__}: {e}"))
+    finally:
+        del inputs, outputs
+        input_shm.close()
+        output_shm.close()
+
+
+class ModelWorkerPool:
+    """
+    Pool de processus modèle alimenté par un anneau de slots en mémoire partagée
+
+    `predict` est bloquant et thread-safe : il est appelé depuis les threads
+    de l'ordonnanceur d'inférence, un par batch concurrent.
+    """
+
+    def __init__(self, num_workers: int = MODEL_WORKERS, threads_per_worker: int = MODEL_WORKER_THREADS,
+                 slot_capacity: int = MODEL_WORKER_SLOT_CAPACITY, pin_cpus: bool = MODEL_WORKER_PIN_CPUS,
+                 timeout_s: float = MODEL_WORKER_TIMEOUT_S, pool_name: str = MODEL_WORKER_POOL_NAME):
+        if num_workers < 1:
+            raise ValueError("MODEL_WORKERS doit être >= 1")
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.slot_capacity = slot_capacity
+        self.pin_cpus = pin_cpus
+        self.timeout_s = timeout_s
+        self.pool_name = pool_name
+        # Deux slots par processus : l'un est traité pendant que l'autre se remplit
+        self.num_slots = 2 * num_workers
+
+        self.state = "pending"
+        self.error: Optional[str] = None
+        self.fingerprint: Optional[str] = None
+        self.workers = {}
+
+        self._processes = []
+        self._lock_file = None
+        self._input_shm = None
+        self._output_shm = None
+        self._inputs = None
+        self._outputs = None
+        self._tasks = None
+        self._results = None
+        self._free_slots = queue.Queue()
+        self._slot_done = [threading.Event() for _ in range(self.num_slots)]
+        self._slot_errors: List[Optional[str]] = [None] * self.num_slots
+        # Slots abandonnés après un délai dépassé : leur tâche peut encore être
+        # en file ou en cours, ils ne sont rendus qu'à la réception de son "done"
+        self._abandoned_slots = set()
+        self._slot_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._dispatcher: Optional[threading.Thread] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def start(self):
+        """Alloue la mémoire partagée et lance les processus (le chargement des modèles est asynchrone)"""
+        if self._processes:
+            return
+
+        # spawn : TensorFlow ne supporte pas fork une fois initialisé
+        ctx = mp.get_context("spawn")
+        self._acquire_pool_name()
+        sample_bytes = int(np.prod(SAMPLE_SHAPE))
+        try:
+            self._input_shm = shared_memory.SharedMemory(name=f"{self.pool_name}_inputs", create=True,
+                                                         size=self.num_slots * self.slot_capacity * sample_bytes)
+            self._output_shm = shared_memory.SharedMemory(name=f"{self.pool_name}_outputs", create=True,
+                                                          size=self.num_slots * self.slot_capacity * 4)
+        except FileExistsError:
+            self._release_pool_name()
+            raise RuntimeError(self._already_running())
+        self._inputs = np.ndarray((self.num_slots, self.slot_capacity) + SAMPLE_SHAPE,
+                                  dtype=np.uint8, buffer=self._input_shm.buf)
+        self._outputs = np.ndarray((self.num_slots, self.slot_capacity), dtype=np.float32, buffer=self._output_shm.buf)
+        for slot in range(self.num_slots):
+            self._free_slots.put(slot)
+
+        self._tasks = ctx.Queue()
+        self._results = ctx.Queue()
+        self.state = "loading"
+        self._dispatcher = threading.Thread(target=self._dispatch_results, name="model-workers", daemon=True)
+        self._dispatcher.start()
+
+        for worker_id in range(self.num_workers):
+            cpus = _cpu_block(worker_id, self.threads_per_worker) if self.pin_cpus else None
+            process = ctx.Process(
+                target=_worker_main,
+                args=(worker_id, self._input_shm.name, self._output_shm.name, self.num_slots,
+                      self.slot_capacity, self.threads_per_worker, cpus, self._tasks, self._results),
+                name=f"model-worker-{worker_id}",
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+
+    def _already_running(self) -> str:
+        return (f"Un pool de processus modèle '{self.pool_name}' tourne déjà : SERVING_MODE=workers exige "
+                f"un seul processus HTTP (pas de uvicorn --workers), ou un MODEL_WORKER_POOL_NAME distinct")
+
+    def _acquire_pool_name(self):
+        """
+        Réserve le nom du pool par un verrou fichier, libéré par le système
+        même si le processus est tué ; un segment restant est alors périmé
+
+        Raises:
+            RuntimeError: Si un autre processus détient déjà ce pool
+        """
+        if fcntl is None:
+            return
+        lock_file = open(os.path.join(tempfile.gettempdir(), f"{self.pool_name}.lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise RuntimeError(self._already_running())
+        self._lock_file = lock_file
+        for suffix in ("inputs", "outputs"):
+            _unlink_stale_segment(f"{self.pool_name}_{suffix}")
+
+    def _release_pool_name(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _dispatch_results(self):
+        while True:
+            message = self._results.get()
+            if message is None:
+                break
+            kind, key, payload = message
+            if kind == "done":
+                with self._slot_lock:
+                    if key in self._abandoned_slots:
+                        self._abandoned_slots.discard(key)
+                        self._free_slots.put(key)
+                        continue
+                    self._slot_errors[key] = payload
+                    self._slot_done[key].set()
+            elif kind == "ready":
+                self.workers[key] = payload
+                self.fingerprint = payload["weights_fingerprint"]
+                if len(self.workers) == self.num_workers and self.state == "loading":
+                    self.state = "ready"
+                    print(f"Pool de {self.num_workers} processus modèle prêt")
+                    self._ready.set()
+            elif kind == "failed":
+                self.state = "failed"
+                self.error = f"processus {key}: {payload}"
+                print(f"⚠️ Échec du chargement du modèle dans le {self.error}")
+                self._ready.set()
+
+    def _check_workers_alive(self):
+        dead = [process.name for process in self._processes if not process.is_alive()]
+        if dead:
+            if self.state != "failed":
+                self.state = "failed"
+                self.error = f"processus arrêté(s): {', '.join(dead)}"
+                print(f"⚠️ Pool de processus modèle en échec: {self.error}")
+                self._ready.set()
+            raise ModelNotReadyError(self.error)
+
+    def _wait_for(self, event: threading.Event) -> bool:
+        """Attend un événement en vérifiant que les processus sont toujours vivants"""
+        deadline = time.monotonic() + self.timeout_s
+        while not event.wait(WORKER_POLL_S):
+            self._check_workers_alive()
+            if time.monotonic() >= deadline:
+                return False
+        return True
+
+    def _wait_ready(self):
+        if self.state == "ready":
+            return
+        if not self._wait_for(self._ready) or self.state != "ready":
+            raise ModelNotReadyError(self.error or "pool de processus modèle en cours de chargement")
+
+    def _acquire_slot(self, in_flight: deque) -> int:
+        """
+        Prend un slot libre ; faute de slot, l'appelant collecte d'abord ses
+        propres slots en cours et ne bloque que s'il n'en détient plus aucun
+        (sinon des batchs concurrents s'attendent mutuellement)
+        """
+        while in_flight:
+            try:
+                return self._free_slots.get_nowait()
+            except queue.Empty:
+                self._collect(*in_flight.popleft())
+        try:
+            return self._free_slots.get(timeout=self.timeout_s)
+        except queue.Empty:
+            raise RuntimeError("Aucun slot de mémoire partagée libre")
+
+    def _submit(self, piece: np.ndarray, in_flight: deque) -> int:
+        slot = self._acquire_slot(in_flight)
+        self._inputs[slot, :len(piece)] = piece
+        self._slot_done[slot].clear()
+        self._tasks.put((slot, len(piece)))
+        return slot
+
+    def _release(self, slot: int):
+        """
+        Rend un slot ; si sa tâche n'est pas terminée, il est mis de côté
+        jusqu'à son "done" pour que personne ne le réécrive entre-temps
+        """
+        with self._slot_lock:
+            if self._slot_done[slot].is_set():
+                self._free_slots.put(slot)
+            else:
+                self._abandoned_slots.add(slot)
+
+    def _collect(self, slot: int, count: int, out: np.ndarray):
+        try:
+            if not self._wait_for(self._slot_done[slot]):
+                raise RuntimeError(f"Délai dépassé en attente du processus modèle (slot {slot})")
+            if self._slot_errors[slot]:
+                raise RuntimeError(self._slot_errors[slot])
+            out[:] = self._outputs[slot, :count]
+        finally:
+            self._release(slot)
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        """
+        Prédit un batch BGR uint8 (N, 50, 50, 3) via les processus modèle
+
+        Les batchs plus grands qu'un slot sont découpés et répartis sur
+        plusieurs processus en parallèle.
+        """
+        self._wait_ready()
+        probas = np.empty(len(batch), dtype=np.float32)
+        in_flight = deque()
+
+        try:
+            for start in range(0, len(batch), self.slot_capacity):
+                if len(in_flight) >= self.num_workers:
+                    self._collect(*in_flight.popleft())
+                piece = batch[start:start + self.slot_capacity]
+                slot = self._submit(piece, in_flight)
+                in_flight.append((slot, len(piece), probas[start:start + len(piece)]))
+
+            while in_flight:
+                self._collect(*in_flight.popleft())
+        finally:
+            # En cas d'erreur, les slots encore en cours ne sont rendus qu'une fois terminés
+            while in_flight:
+                self._release(in_flight.popleft()[0])
+
+        return probas
+
+    def stop(self):
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+
+        if self._results is not None:
+            self._results.put(None)
+        if self._dispatcher is not None:
+            self._dispatcher.join(timeout=5)
+
+        self._inputs = self._outputs = None
+        for shm in (self._input_shm, self._output_shm):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self._input_shm = self._output_shm = None
+        self._release_pool_name()
+        self.state = "stopped"
+
+    def status(self) -> dict:
+        """État du pool, au même format que ModelLoader.status"""
+        first = self.workers.get(0, {})
+        return {
+            "status": self.state,
+            "ready": self.ready,
+            "error": self.error,
+            "load_mode": "workers",
+            "weights_path": MODEL_WEIGHTS_PATH,
+            "weights_fingerprint": self.fingerprint,
+            "backend": first.get("backend"),
+            "backend_report": first.get("backend_report", {}),
+            "phases_ms": first.get("phases_ms", {}),
+            "pool_name": self.pool_name,
+            "num_workers": self.num_workers,
+            "threads_per_worker": self.threads_per_worker,
+            "slot_capacity": self.slot_capacity,
+            "num_slots": self.num_slots,
+            "free_slots": self._free_slots.qsize(),
+            "abandoned_slots": len(self._abandoned_slots),
+            "workers": [self.workers.get(worker_id, {"status": "loading"}) for worker_id in range(self.num_workers)],
+        }
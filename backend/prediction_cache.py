@@ -0,0 +1,241 @@
+"""
+Cache des prédictions adressé par contenu
+La clé combine une empreinte des pixels décodés et redimensionnés (50x50)
+et l'empreinte des poids du modèle : une même image réencodée reste un hit,
+et tout changement de poids invalide le cache
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from model_loader import weights_fingerprint
+
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "10000"))
+# Niveau disque optionnel (SQLite), conservé entre deux redémarrages
+PREDICTION_CACHE_DB = os.getenv("PREDICTION_CACHE_DB")
+PREDICTION_CACHE_DISK_MAX = int(os.getenv("PREDICTION_CACHE_DISK_MAX", "1000000"))
+# Intervalle minimal entre deux vérifications du fichier de poids
+WEIGHTS_CHECK_INTERVAL_S = 1.0
+# Le niveau disque n'est élagué qu'une fois toutes les N écritures
+DISK_TRIM_EVERY = 1000
+
+
+def pixel_digest(img: np.ndarray) -> str:
+    """Empreinte du buffer de pixels BGR (forme et type inclus)"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(("bgr", img.shape, img.dtype.str)).encode())
+    digest.update(np.ascontiguousarray(img).data)
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """
+    LRU en mémoire, niveau SQLite optionnel et compteurs de hits/misses
+
+    Le cache n'est utilisé que si les poids chargés en mémoire correspondent
+    au fichier de poids sur disque : si le fichier change, le cache est vidé
+    et contourné jusqu'au rechargement du modèle.
+    """
+
+    def __init__(self, fingerprint_fn: Callable[[], Optional[str]], weights_path: str,
+                 max_entries: int = PREDICTION_CACHE_SIZE, db_path: Optional[str] = PREDICTION_CACHE_DB,
+                 disk_max_entries: int = PREDICTION_CACHE_DISK_MAX):
+        self.fingerprint_fn = fingerprint_fn
+        self.weights_path = weights_path
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.disk_max_entries = disk_max_entries
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._fingerprint: Optional[str] = None
+        self._weights_stat = None
+        self._weights_checked_at = 0.0
+        self._stale = False
+        self._disk_writes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS predictions ("
+                "key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, proba REAL NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_predictions_created_at ON predictions (created_at)")
+            self._db.commit()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 or self._db is not None
+
+    def _weights_stat_signature(self):
+        try:
+            stat = os.stat(self.weights_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _file_fingerprint(self) -> Optional[str]:
+        try:
+            return weights_fingerprint(self.weights_path)
+        except OSError:
+            return None
+
+    def _active_fingerprint(self) -> Tuple[Optional[str], Optional[tuple]]:
+        """
+        Empreinte des poids servis (None si le cache doit être contourné) et,
+        si le fichier de poids a changé, sa signature à vérifier par hachage
+
+        Doit être appelé avec self._lock ; le hachage se fait ensuite hors du
+        verrou (voir _check_weights_file).
+        """
+        fingerprint = self.fingerprint_fn()
+        if fingerprint is None:
+            return None, None
+
+        if fingerprint != self._fingerprint:
+            # Nouveau modèle chargé (ou premier démarrage avec d'autres poids) :
+            # les prédictions des autres empreintes ne sont plus valides
+            self._invalidate(keep_fingerprint=fingerprint, count=self._fingerprint is not None)
+            self._fingerprint = fingerprint
+            self._weights_stat = self._weights_stat_signature()
+            self._stale = False
+
+        changed = None
+        now = time.monotonic()
+        if now - self._weights_checked_at >= WEIGHTS_CHECK_INTERVAL_S:
+            self._weights_checked_at = now
+            signature = self._weights_stat_signature()
+            if signature != self._weights_stat and not self._stale:
+                # Signature notée tout de suite : un seul appelant hache le fichier
+                self._weights_stat = signature
+                changed = signature
+
+        return (None if self._stale else fingerprint), changed
+
+    def _check_weights_file(self, fingerprint: str, signature: tuple) -> Optional[str]:
+        """
+        Hache le fichier de poids modifié hors du verrou (SHA-256 complet), puis
+        invalide le cache s'il ne correspond plus au modèle servi
+        """
+        file_fingerprint = self._file_fingerprint()
+        with self._lock:
+            # Modèle rechargé ou fichier encore modifié pendant le hachage : résultat périmé
+            if self._fingerprint == fingerprint and self._weights_stat == signature and not self._stale \
+                    and file_fingerprint != fingerprint:
+                print("⚠️ Fichier de poids modifié : cache des prédictions invalidé jusqu'au rechargement du modèle")
+                self._invalidate(keep_fingerprint=None)
+                self._stale = True
+            return None if self._stale or self._fingerprint != fingerprint else fingerprint
+
+    def _invalidate(self, keep_fingerprint: Optional[str], count: bool = True):
+        self._entries.clear()
+        if count:
+            self.invalidations += 1
+        if self._db is not None:
+            self._db.execute("DELETE FROM predictions WHERE fingerprint != ?", (keep_fingerprint or "",))
+            self._db.commit()
+
+    def make_key(self, img: np.ndarray) -> Optional[str]:
+        """Clé de cache d'une image 50x50 décodée (None si le cache est contourné)"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            fingerprint, changed = self._active_fingerprint()
+        if fingerprint is not None and changed is not None:
+            fingerprint = self._check_weights_file(fingerprint, changed)
+        if fingerprint is None:
+            return None
+        return f"{fingerprint[:16]}:{pixel_digest(img)}"
+
+    def get(self, key: Optional[str]) -> Optional[float]:
+        if key is None:
+            return None
+
+        with self._lock:
+            proba = self._entries.get(key)
+            if proba is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return proba
+
+            if self._db is not None:
+                row = self._db.execute("SELECT proba FROM predictions WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    self._remember(key, row[0])
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key: Optional[str], proba: float):
+        if key is None:
+            return
+
+        with self._lock:
+            # La clé a pu être calculée avant une invalidation
+            if self._stale or not key.startswith((self._fingerprint or "")[:16] + ":"):
+                return
+            self._remember(key, proba)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO predictions (key, fingerprint, proba, created_at) VALUES (?, ?, ?, ?)",
+                    (key, self._fingerprint, float(proba), time.time())
+                )
+                self._db.commit()
+                self._disk_writes += 1
+                if self._disk_writes % DISK_TRIM_EVERY == 0:
+                    self._trim_disk()
+
+    def _remember(self, key: str, proba: float):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = proba
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _trim_disk(self):
+        count = self._db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        if count > self.disk_max_entries:
+            self._db.execute(
+                "DELETE FROM predictions WHERE key IN "
+                "(SELECT key FROM predictions ORDER BY created_at LIMIT ?)",
+                (count - self.disk_max_entries,)
+            )
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._invalidate(keep_fingerprint=None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "disk_enabled": self._db is not None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "bypassed": self._stale,
+            "weights_fingerprint": self._fingerprint,
+        }
@@ -0,0 +1,187 @@
+"""
+Étape de prétraitement des images
+Décodage dans un pool de threads (OpenCV libère le GIL), décodage en
+résolution réduite pour les grandes sources, rejet précoce des entrées
+invalides et conversion RGB + normalisation fusionnées dans un buffer
+de batch préalloué
+"""
+
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from metrics import INPUT_IMAGE_PIXELS, INPUT_IMAGE_SIDE, INPUT_UPLOAD_BYTES, PREDICT_STAGE
+
+IMG_SIZE = (50, 50)
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(50_000_000)))
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(os.cpu_count() or 4)))
+
+# Une réduction n'est appliquée que si l'image réduite garde au moins
+# deux fois la taille cible, pour que le redimensionnement final reste fidèle
+REDUCED_DECODE_MARGIN = 2
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_SCALE = np.float32(1.0 / 255.0)
+
+decode_executor = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix="decode")
+_buffers = threading.local()
+
+
+class ImageRejectedError(ValueError):
+    """Entrée refusée avant inférence ; porte le code HTTP à renvoyer"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _read_tiff_size(data: bytes):
+    """Dimensions de la première page d'un TIFF classique (tags ImageWidth et ImageLength)"""
+    order = "little" if data[:2] == b"II" else "big"
+    offset = int.from_bytes(data[4:8], order)
+    if offset + 2 > len(data):
+        return None
+    count = int.from_bytes(data[offset:offset + 2], order)
+    size = {}
+    for entry in range(offset + 2, min(offset + 2 + 12 * count, len(data) - 11), 12):
+        tag = int.from_bytes(data[entry:entry + 2], order)
+        if tag in (256, 257):
+            field_type = int.from_bytes(data[entry + 2:entry + 4], order)
+            # SHORT (3) sur 2 octets, LONG (4) sur 4 octets, cadrés au début du champ valeur
+            length = 2 if field_type == 3 else 4
+            size[tag] = int.from_bytes(data[entry + 8:entry + 8 + length], order)
+    if 256 not in size or 257 not in size:
+        return None
+    return "tiff", size[256], size[257]
+
+
+def read_image_size(data: bytes):
+    """
+    Lit (format, largeur, hauteur) dans l'en-tête PNG, JPEG, TIFF ou BMP, sans décoder
+
+    Returns:
+        Un tuple (format, largeur, hauteur), ou None si le format n'est pas reconnu
+    """
+    if data[:8] == _PNG_SIGNATURE and len(data) >= 24:
+        return "png", int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+
+    if data[:4] in (b"II*\x00", b"MM\x00*"):
+        return _read_tiff_size(data)
+
+    if data[:2] == b"BM" and len(data) >= 26:
+        # Hauteur négative : lignes stockées de haut en bas
+        return ("bmp", abs(int.from_bytes(data[18:22], "little", signed=True)),
+                abs(int.from_bytes(data[22:26], "little", signed=True)))
+
+    if data[:2] != b"\xff\xd8":
+        return None
+
+    # Parcours des segments JPEG jusqu'au marqueur SOF qui porte les dimensions
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(data[i + 5:i + 7], "big")
+            width = int.from_bytes(data[i + 7:i + 9], "big")
+            return "jpeg", width, height
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+
+    return None
+
+
+def _decode_flag(image_format: str, width: int, height: int) -> int:
+    # Seul libjpeg décode réellement moins de pixels (mise à l'échelle DCT)
+    if image_format != "jpeg":
+        return cv2.IMREAD_COLOR
+    smallest = min(width / IMG_SIZE[0], height / IMG_SIZE[1])
+    for factor, flag in _REDUCED_FLAGS:
+        if smallest / factor >= REDUCED_DECODE_MARGIN:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def decode_image(image_bytes: bytes, max_bytes: int = MAX_UPLOAD_BYTES,
+                 max_pixels: int = MAX_IMAGE_PIXELS) -> np.ndarray:
+    """
+    Décode une image en BGR uint8 redimensionnée à 50x50
+
+    La conversion RGB et la normalisation sont faites plus tard, en une
+    seule passe sur le batch (voir to_model_input).
+
+    Raises:
+        ImageRejectedError: Fichier vide, trop volumineux ou illisible
+    """
+    if not image_bytes:
+        raise ImageRejectedError("Fichier vide", 400)
+    INPUT_UPLOAD_BYTES.observe(len(image_bytes))
+    if len(image_bytes) > max_bytes:
+        raise ImageRejectedError(f"Fichier trop volumineux (maximum {max_bytes} octets)", 413)
+
+    flag = cv2.IMREAD_COLOR
+    header = read_image_size(image_bytes)
+    if header is not None:
+        image_format, width, height = header
+        if width * height > max_pixels:
+            raise ImageRejectedError(f"Image trop grande ({width}x{height}, maximum {max_pixels} pixels)", 413)
+        flag = _decode_flag(image_format, width, height)
+
+    started = time.perf_counter()
+    img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flag)
+    decoded = time.perf_counter()
+    PREDICT_STAGE.observe(decoded - started, stage="imdecode")
+    if img is None:
+        raise ImageRejectedError("Image illisible ou format non supporté", 400)
+
+    # Dimensions de la source, et non de l'image décodée en résolution réduite
+    if header is None:
+        width, height = img.shape[1], img.shape[0]
+    INPUT_IMAGE_PIXELS.observe(width * height)
+    INPUT_IMAGE_SIDE.observe(width, axis="width")
+    INPUT_IMAGE_SIDE.observe(height, axis="height")
+
+    if img.shape[1] != IMG_SIZE[0] or img.shape[0] != IMG_SIZE[1]:
+        img = cv2.resize(img, IMG_SIZE)
+        PREDICT_STAGE.observe(time.perf_counter() - decoded, stage="resize")
+    return img
+
+
+def to_model_input(batch_bgr: np.ndarray) -> np.ndarray:
+    """
+    Convertit un batch BGR uint8 en entrée du modèle (RGB float32 dans [0, 1])
+
+    Inversion des canaux et normalisation en une seule opération, écrite
+    dans un buffer préalloué propre au thread appelant. Le résultat est
+    réutilisé au batch suivant : il ne doit pas être conservé.
+    """
+    count = batch_bgr.shape[0]
+    sample_shape = batch_bgr.shape[1:]
+    buffer = getattr(_buffers, "batch", None)
+    if buffer is None or buffer.shape[0] < count or buffer.shape[1:] != sample_shape:
+        buffer = np.empty((count,) + sample_shape, dtype=np.float32)
+        _buffers.batch = buffer
+
+    out = buffer[:count]
+    with PREDICT_STAGE.time(stage="normalize"):
+        np.multiply(batch_bgr[..., ::-1], _SCALE, out=out)
+    return out
+
+
+async def run_in_decode_pool(fn, *args):
+    """Exécute une fonction de décodage dans le pool dédié"""
+    return await asyncio.get_running_loop().run_in_executor(decode_executor, fn, *args)
@@ -0,0 +1,149 @@
+"""
+Profileur par échantillonnage des requêtes lentes (optionnel)
+Pendant qu'une requête est en cours, un thread relève périodiquement la
+pile de tous les threads ; les N requêtes les plus lentes conservent leurs
+piles agrégées au format « folded » (flamegraph.pl, speedscope)
+"""
+
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from typing import List, Optional
+
+# 0 : profileur désactivé
+PROFILE_SLOWEST_N = int(os.getenv("PROFILE_SLOWEST_N", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# Dossier optionnel où écrire un fichier .folded par requête retenue
+PROFILE_DUMP_DIR = os.getenv("PROFILE_DUMP_DIR")
+# Profondeur maximale d'une pile relevée
+MAX_STACK_DEPTH = 64
+# Threads inactifs (en attente d'une tâche) : leurs piles ne sont pas relevées
+_IDLE_LEAVES = {("threading.py", "wait"), ("queue.py", "get"), ("selectors.py", "select"), ("thread.py", "_worker")}
+
+
+class _ActiveProfile:
+    __slots__ = ("stacks", "samples", "started_at")
+
+    def __init__(self):
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.started_at = time.time()
+
+
+def _is_idle(frame) -> bool:
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _IDLE_LEAVES
+
+
+def _folded_stack(thread_name: str, frame) -> str:
+    parts = []
+    while frame is not None and len(parts) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    parts.append(thread_name)
+    return ";".join(reversed(parts))
+
+
+class SlowRequestProfiler:
+    """
+    Échantillonne les piles pendant les requêtes et garde les N plus lentes
+
+    Les échantillons sont pris sur tous les threads (boucle d'événements,
+    pool de décodage, thread du modèle) : quand plusieurs requêtes se
+    chevauchent, chacune reçoit les piles de la période commune.
+    """
+
+    def __init__(self, slowest_n: int = PROFILE_SLOWEST_N, interval_ms: float = PROFILE_INTERVAL_MS,
+                 dump_dir: Optional[str] = PROFILE_DUMP_DIR):
+        self.slowest_n = slowest_n
+        self.interval_s = interval_ms / 1000.0
+        self.dump_dir = dump_dir
+        self._active = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        # Tas min sur la durée : la racine est la plus rapide des requêtes retenues
+        self._slowest = []
+        self._ids = itertools.count()
+
+    @property
+    def enabled(self) -> bool:
+        return self.slowest_n > 0
+
+    def begin(self) -> Optional[_ActiveProfile]:
+        if not self.enabled:
+            return None
+        profile = _ActiveProfile()
+        with self._lock:
+            self._active.add(profile)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+                self._sampler.start()
+        self._wake.set()
+        return profile
+
+    def end(self, profile: _ActiveProfile, endpoint: str, path: str, duration_s: float):
+        with self._lock:
+            self._active.discard(profile)
+            if len(self._slowest) >= self.slowest_n and duration_s <= self._slowest[0][0]:
+                return
+            entry = {
+                "id": next(self._ids),
+                "endpoint": endpoint,
+                "path": path,
+                "started_at": profile.started_at,
+                "duration_ms": duration_s * 1000.0,
+                "samples": profile.samples,
+                "folded": "\n".join(f"{stack} {count}" for stack, count in profile.stacks.most_common()),
+            }
+            evicted = None
+            if len(self._slowest) < self.slowest_n:
+                heapq.heappush(self._slowest, (duration_s, entry["id"], entry))
+            else:
+                evicted = heapq.heapreplace(self._slowest, (duration_s, entry["id"], entry))[2]
+
+        if self.dump_dir:
+            self._dump(entry, evicted)
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        while True:
+            with self._lock:
+                idle = not self._active
+                if idle:
+                    self._wake.clear()
+            if idle:
+                self._wake.wait()
+                continue
+
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = [_folded_stack(names.get(ident, str(ident)), frame)
+                      for ident, frame in sys._current_frames().items()
+                      if ident != own_id and not _is_idle(frame)]
+            with self._lock:
+                for profile in self._active:
+                    profile.samples += 1
+                    profile.stacks.update(stacks)
+            time.sleep(self.interval_s)
+
+    def _dump_path(self, entry: dict) -> str:
+        return os.path.join(self.dump_dir, f"{entry['id']:06d}_{entry['endpoint']}_{entry['duration_ms']:.0f}ms.folded")
+
+    def _dump(self, entry: dict, evicted: Optional[dict]):
+        try:
+            os.makedirs(self.dump_dir, exist_ok=True)
+            with open(self._dump_path(entry), "w") as f:
+                f.write(entry["folded"] + "\n")
+            if evicted is not None and os.path.exists(self._dump_path(evicted)):
+                os.remove(self._dump_path(evicted))
+        except OSError as e:
+            print(f"⚠️ Impossible d'écrire le profil: {e}")
+
+    def slowest(self) -> List[dict]:
+        """Requêtes retenues, de la plus lente à la plus rapide"""
+        with self._lock:
+            return [entry for _, _, entry in sorted(self._slowest, key=lambda item: item[:2], reverse=True)]
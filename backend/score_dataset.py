@@ -0,0 +1,377 @@
+"""
+Scoring hors ligne de jeux de patchs IDC
+
+    python score_dataset.py ../0 ../1 --output scores.csv --metrics
+    python score_dataset.py /data/idc --output scores.parquet --format parquet --batch-size 1024
+
+Même modèle et même prétraitement que script.py (decode_image puis
+predict_batch). Décodage parallèle dans un pool de threads avec
+préchargement des batchs suivants pendant l'inférence, écriture
+incrémentale et points de reprise : relancer la même commande après
+une interruption reprend là où elle s'était arrêtée.
+
+Les étiquettes réelles sont lues dans les noms de fichiers (..._class0.png,
+..._class1.png) pour le résumé des métriques.
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional
+
+import numpy as np
+
+from preprocessing import decode_image
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+COLUMNS = ("path", "probability", "predicted", "label", "error")
+LABEL_PATTERN = re.compile(r"class([01])\.\w+$")
+# Résolution de l'histogramme des probabilités (AUC approchée)
+AUC_BINS = 1000
+
+
+def list_images(inputs: List[str]) -> List[str]:
+    """Chemins des images sous les dossiers (ou fichiers) donnés, dans un ordre stable"""
+    paths = []
+    for root in inputs:
+        if os.path.isfile(root):
+            paths.append(root)
+            continue
+        if not os.path.isdir(root):
+            raise FileNotFoundError(f"Entrée introuvable: {root}")
+        for directory, subdirectories, files in os.walk(root):
+            subdirectories.sort()
+            paths.extend(os.path.join(directory, name) for name in sorted(files)
+                         if name.lower().endswith(IMAGE_EXTENSIONS))
+    return paths
+
+
+def inputs_signature(paths: List[str]) -> str:
+    """Empreinte de la liste ordonnée des entrées : une reprise exige la même liste"""
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path.encode("utf-8", "surrogateescape"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def label_from_filename(path: str) -> Optional[int]:
+    match = LABEL_PATTERN.search(os.path.basename(path))
+    return int(match.group(1)) if match else None
+
+
+def _load_and_decode(path: str):
+    try:
+        with open(path, "rb") as f:
+            return decode_image(f.read()), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def decoded_batches(paths: List[str], batch_size: int, executor: ThreadPoolExecutor,
+                    prefetch: int) -> Iterator[tuple]:
+    """
+    Produit (chemins, images décodées ou None, erreurs) par batch
+
+    Les `prefetch` batchs suivants sont soumis au pool de décodage à
+    l'avance : ils se décodent pendant l'inférence du batch courant.
+    """
+    starts = iter(range(0, len(paths), batch_size))
+    window = deque()
+
+    def _submit_next():
+        start = next(starts, None)
+        if start is None:
+            return
+        batch_paths = paths[start:start + batch_size]
+        window.append((batch_paths, [executor.submit(_load_and_decode, path) for path in batch_paths]))
+
+    for _ in range(prefetch + 1):
+        _submit_next()
+
+    while window:
+        batch_paths, futures = window.popleft()
+        _submit_next()
+        results = [future.result() for future in futures]
+        yield batch_paths, [img for img, _ in results], [error for _, error in results]
+
+
+class CsvSink:
+    """CSV unique, tronqué au dernier point de reprise lors d'une reprise"""
+
+    def __init__(self, path: str, resume_state: Optional[dict]):
+        self.path = path
+        if resume_state is not None:
+            self._file = open(path, "r+", newline="", encoding="utf-8")
+            self._file.truncate(resume_state["offset"])
+            self._file.seek(resume_state["offset"])
+            self._writer = csv.writer(self._file)
+        else:
+            self._file = open(path, "w", newline="", encoding="utf-8")
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(COLUMNS)
+
+    def write(self, rows: List[tuple]):
+        self._writer.writerows(rows)
+
+    def checkpoint(self) -> dict:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return {"offset": self._file.tell()}
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetSink:
+    """
+    Dossier de fichiers Parquet, un par point de reprise (lisible comme un
+    seul jeu de données par pyarrow ou pandas)
+    """
+
+    def __init__(self, path: str, resume_state: Optional[dict]):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Le format parquet nécessite pyarrow (pip install pyarrow)")
+        self._pa, self._pq = pa, pq
+        self.path = path
+        self._parts = resume_state["parts"] if resume_state is not None else 0
+        self._rows: List[tuple] = []
+
+        os.makedirs(path, exist_ok=True)
+        # Parties écrites après le dernier point de reprise : incomplètes
+        for name in os.listdir(path):
+            if name.startswith("part-") and int(name[5:10]) >= self._parts:
+                os.remove(os.path.join(path, name))
+
+    def write(self, rows: List[tuple]):
+        self._rows.extend(rows)
+
+    def checkpoint(self) -> dict:
+        if self._rows:
+            columns = list(zip(*self._rows))
+            table = self._pa.table({
+                "path": self._pa.array(columns[0], self._pa.string()),
+                "probability": self._pa.array(columns[1], self._pa.float32()),
+                "predicted": self._pa.array(columns[2], self._pa.int8()),
+                "label": self._pa.array(columns[3], self._pa.int8()),
+                "error": self._pa.array(columns[4], self._pa.string()),
+            })
+            part_path = os.path.join(self.path, f"part-{self._parts:05d}.parquet")
+            self._pq.write_table(table, part_path + ".tmp")
+            os.replace(part_path + ".tmp", part_path)
+            self._parts += 1
+            self._rows = []
+        return {"parts": self._parts}
+
+    def close(self):
+        pass
+
+
+class LabelMetrics:
+    """Matrice de confusion et histogrammes des probabilités par classe, cumulables entre reprises"""
+
+    def __init__(self, threshold: float, state: Optional[dict] = None):
+        self.threshold = threshold
+        state = state or {}
+        self.confusion = np.array(state.get("confusion", [[0, 0], [0, 0]]), dtype=np.int64)
+        self.histograms = np.array(state.get("histograms", np.zeros((2, AUC_BINS))), dtype=np.int64)
+
+    def update(self, probabilities: np.ndarray, labels: np.ndarray):
+        predicted = (probabilities > self.threshold).astype(np.int64)
+        np.add.at(self.confusion, (labels, predicted), 1)
+        bins = np.minimum((probabilities * AUC_BINS).astype(np.int64), AUC_BINS - 1)
+        np.add.at(self.histograms, (labels, bins), 1)
+
+    def state(self) -> dict:
+        return {"confusion": self.confusion.tolist(), "histograms": self.histograms.tolist()}
+
+    def summary(self) -> dict:
+        (tn, fp), (fn, tp) = self.confusion.tolist()
+        total = tn + fp + fn + tp
+
+        def _ratio(numerator, denominator):
+            return numerator / denominator if denominator else None
+
+        precision, recall = _ratio(tp, tp + fp), _ratio(tp, tp + fn)
+        specificity = _ratio(tn, tn + fp)
+        f1 = _ratio(2 * precision * recall, precision + recall) if None not in (precision, recall) else None
+
+        # AUC = P(score positif > score négatif), ex aequo comptés pour moitié
+        negatives, positives = self.histograms
+        auc = None
+        if negatives.sum() and positives.sum():
+            negatives_below = np.concatenate(([0], np.cumsum(negatives)[:-1]))
+            auc = float((positives * (negatives_below + 0.5 * negatives)).sum() / (positives.sum() * negatives.sum()))
+
+        return {
+            "labelled": total,
+            "threshold": self.threshold,
+            "confusion": {"tn": tn, "fp": fp, "fn": fn, "tp": tp},
+            "accuracy": _ratio(tp + tn, total),
+            "precision": precision,
+            "recall": recall,
+            "specificity": specificity,
+            "f1": f1,
+            "balanced_accuracy": (recall + specificity) / 2 if recall is not None and specificity is not None else None,
+            "roc_auc": auc,
+        }
+
+
+def _read_checkpoint(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_checkpoint(path: str, state: dict):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def score(args) -> dict:
+    from script import model_loader, predict_batch
+
+    paths = list_images(args.inputs)
+    if args.limit:
+        paths = paths[:args.limit]
+    if not paths:
+        raise ValueError("Aucune image trouvée")
+    signature = inputs_signature(paths)
+
+    print(f"{len(paths)} images, chargement du modèle...")
+    model_loader.load()
+    fingerprint = model_loader.fingerprint
+
+    checkpoint_path = args.output.rstrip("/") + ".checkpoint.json"
+    checkpoint = None if args.restart else _read_checkpoint(checkpoint_path)
+    if checkpoint is not None:
+        if checkpoint["inputs_signature"] != signature:
+            raise ValueError("Les entrées ont changé depuis le point de reprise : relancez avec --restart")
+        if checkpoint["weights_fingerprint"] != fingerprint:
+            raise ValueError("Les poids du modèle ont changé depuis le point de reprise : relancez avec --restart")
+        if checkpoint["format"] != args.format:
+            raise ValueError(f"Le point de reprise concerne le format {checkpoint['format']}")
+        print(f"Reprise après {checkpoint['rows']} images")
+    elif os.path.exists(args.output) and not args.restart:
+        raise ValueError(f"{args.output} existe déjà sans point de reprise : relancez avec --restart pour l'écraser")
+
+    done = checkpoint["rows"] if checkpoint else 0
+    sink_class = ParquetSink if args.format == "parquet" else CsvSink
+    sink = sink_class(args.output, checkpoint["sink"] if checkpoint else None)
+    metrics = LabelMetrics(args.threshold, checkpoint["metrics"] if checkpoint else None)
+    errors = checkpoint["errors"] if checkpoint else 0
+
+    def _save(rows_done: int):
+        _write_checkpoint(checkpoint_path, {
+            "format": args.format,
+            "inputs_signature": signature,
+            "weights_fingerprint": fingerprint,
+            "rows": rows_done,
+            "errors": errors,
+            "sink": sink.checkpoint(),
+            "metrics": metrics.state(),
+        })
+
+    started = time.perf_counter()
+    scored = 0
+    remaining = paths[done:]
+    try:
+        with ThreadPoolExecutor(max_workers=args.decode_workers, thread_name_prefix="decode") as executor:
+            batches = decoded_batches(remaining, args.batch_size, executor, args.prefetch)
+            for batch_index, (batch_paths, images, batch_errors) in enumerate(batches, start=1):
+                valid = [img for img in images if img is not None]
+                probabilities = iter(predict_batch(np.stack(valid)) if valid else [])
+
+                rows, labelled_probas, labelled_truth = [], [], []
+                for path, img, error in zip(batch_paths, images, batch_errors):
+                    label = label_from_filename(path)
+                    if img is None:
+                        errors += 1
+                        rows.append((path, None, None, label, error))
+                        continue
+                    proba = float(next(probabilities))
+                    rows.append((path, round(proba, 6), int(proba > args.threshold), label, None))
+                    if label is not None:
+                        labelled_probas.append(proba)
+                        labelled_truth.append(label)
+
+                sink.write(rows)
+                if labelled_probas:
+                    metrics.update(np.asarray(labelled_probas), np.asarray(labelled_truth))
+                scored += len(batch_paths)
+
+                if batch_index % args.checkpoint_every == 0:
+                    _save(done + scored)
+                    rate = scored / (time.perf_counter() - started)
+                    print(f"  {done + scored}/{len(paths)} images ({rate:.0f} images/s)")
+    finally:
+        # Interruption comprise : les batchs complets sont conservés
+        _save(done + scored)
+        sink.close()
+
+    elapsed = time.perf_counter() - started
+    summary = {
+        "images": len(paths),
+        "scored_this_run": scored,
+        "resumed_from": done,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 2),
+        "images_per_s": round(scored / elapsed, 1) if elapsed > 0 else None,
+        "weights_fingerprint": fingerprint,
+        "backend": model_loader.status()["backend"],
+        "output": args.output,
+    }
+    if args.metrics:
+        summary["metrics"] = metrics.summary()
+    return summary
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Score un jeu de patchs avec le modèle IDC")
+    parser.add_argument("inputs", nargs="+", help="Dossiers (parcourus récursivement) ou images")
+    parser.add_argument("--output", required=True, help="Fichier CSV ou dossier Parquet")
+    parser.add_argument("--format", choices=("csv", "parquet"), default=None,
+                        help="Déduit de l'extension de --output par défaut")
+    parser.add_argument("--batch-size", type=int, default=512)
+    parser.add_argument("--decode-workers", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--prefetch", type=int, default=2, help="Batchs décodés à l'avance")
+    parser.add_argument("--checkpoint-every", type=int, default=20, help="Point de reprise tous les N batchs")
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--metrics", action="store_true", help="Métriques d'après les étiquettes des noms de fichiers")
+    parser.add_argument("--restart", action="store_true", help="Ignore le point de reprise et écrase la sortie")
+    parser.add_argument("--limit", type=int, help="Ne score que les N premières images")
+    args = parser.parse_args(argv)
+    if args.format is None:
+        args.format = "parquet" if args.output.rstrip("/").endswith(".parquet") else "csv"
+
+    try:
+        summary = score(args)
+    except (ValueError, FileNotFoundError, RuntimeError) as e:
+        print(f"⚠️ {e}")
+        return 1
+    except KeyboardInterrupt:
+        print("Interrompu : relancez la même commande pour reprendre")
+        return 130
+
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    with open(args.output.rstrip("/") + ".summary.json", "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
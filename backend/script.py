@@ -1,13 +1,15 @@
-from tensorflow.keras.models import Model
-from tensorflow.keras.layers import GlobalAveragePooling2D, Dense, Dropout, BatchNormalization
-from tensorflow.keras.applications import ResNet50
-import cv2
 import numpy as np
+from metrics import PREDICT_STAGE
+from model_loader import ModelLoader
+from preprocessing import decode_image, to_model_input
 
-IMG_SIZE = (50, 50)
+def create_model(input_shape=(50, 50, 3), weights='imagenet'):
+    # Import local : importer ce module ne doit pas charger TensorFlow
+    from tensorflow.keras.models import Model
+    from tensorflow.keras.layers import GlobalAveragePooling2D, Dense, Dropout, BatchNormalization
+    from tensorflow.keras.applications import ResNet50
 
-def create_model(input_shape=(50, 50, 3)):
-    base_model = ResNet50(weights='imagenet', include_top=False, input_shape=input_shape)
+    base_model = ResNet50(weights=weights, include_top=False, input_shape=input_shape)
     for layer in base_model.layers[:-20]:
         layer.trainable = False
     x = base_model.output
@@ -21,24 +23,28 @@ def create_model(input_shape=(50, 50, 3)):
     model = Model(inputs=base_model.input, outputs=predictions)
     return model
 
-model = create_model()
-model.load_weights("idc_breast_cancer_model_final/model.weights.h5")
-print("Modèle chargé avec succès ")
+# Le modèle est reconstruit depuis config.json (sans ImageNet) au démarrage ou au premier usage
+model_loader = ModelLoader()
 
-def predict_from_bytes(image_bytes):
-
-    npimg = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(npimg, cv2.IMREAD_COLOR)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    img = cv2.resize(img, IMG_SIZE)
-    img = img.astype('float32') / 255.0
-    img = np.expand_dims(img, axis=0)
+def predict_batch(batch):
+    """
+    Un seul appel au backend d'inférence pour un batch BGR uint8 (N, 50, 50, 3)
+    La conversion RGB et la normalisation sont fusionnées juste avant le modèle
+    """
+    backend = model_loader.get_backend()
+    inputs = to_model_input(batch)
+    with PREDICT_STAGE.time(stage="model"):
+        return backend.predict(inputs)
 
-    proba = model.predict(img, verbose=0)[0][0]
+def format_prediction(proba):
     label = "IDC POSITIF (Cancer)" if proba > 0.5 else "IDC NÉGATIF (Pas de cancer)"
-
     return {"label": label, "confidence": float(proba)}
 
+def predict_from_bytes(image_bytes):
 
+    img = decode_image(image_bytes)
+    img = np.expand_dims(img, axis=0)
 
+    proba = predict_batch(img)[0]
 
+    return format_prediction(proba)
@@ -0,0 +1,360 @@
+"""
+Mode tuilage pour les grandes images histopathologiques
+Découpe l'image en patchs 50x50, écarte le fond, score les patchs de tissu
+par gros batchs et renvoie un score agrégé et une carte de chaleur
+
+Les TIFF (à bandes ou tuilées) sont lues bande par bande avec tifffile,
+si ce paquet est installé ; les autres formats sont décodés en entier
+"""
+
+import asyncio
+import os
+import warnings
+from typing import BinaryIO, Optional, Tuple
+
+import cv2
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from inference_queue import InferenceScheduler
+from preprocessing import IMG_SIZE, ImageRejectedError, read_image_size, run_in_decode_pool
+from script import format_prediction
+
+TILE_SIZE = IMG_SIZE[0]
+
+TILING_BATCH_SIZE = int(os.getenv("TILING_BATCH_SIZE", "512"))
+TILING_BAND_ROWS = int(os.getenv("TILING_BAND_ROWS", "8"))
+TILING_MAX_TILES = int(os.getenv("TILING_MAX_TILES", "500000"))
+TILING_HEATMAP_MAX_SIZE = int(os.getenv("TILING_HEATMAP_MAX_SIZE", "64"))
+# Formats décodés en entier (PNG, JPEG, BMP, TIFF non lisible par bandes) :
+# ces plafonds bornent la mémoire d'une requête (200 Mpx, environ 600 Mo en BGR uint8)
+TILING_MAX_UPLOAD_BYTES = int(os.getenv("TILING_MAX_UPLOAD_BYTES", str(256 * 1024 * 1024)))
+TILING_MAX_PIXELS = int(os.getenv("TILING_MAX_PIXELS", str(200_000_000)))
+# Requêtes de tuilage traitées en même temps ; les suivantes attendent leur tour
+TILING_MAX_CONCURRENT = int(os.getenv("TILING_MAX_CONCURRENT", "1"))
+# Pixels maximaux d'une bande : les images très larges sont lues par bandes moins hautes
+BAND_MAX_PIXELS = 16_000_000
+
+_TIFF_MAGIC = (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+")
+_tiling_slots = asyncio.Semaphore(TILING_MAX_CONCURRENT)
+
+# Un pixel est du fond s'il est clair et peu saturé (lame blanche)
+TISSUE_MAX_BRIGHTNESS = int(os.getenv("TISSUE_MAX_BRIGHTNESS", "220"))
+TISSUE_MIN_SATURATION = int(os.getenv("TISSUE_MIN_SATURATION", "20"))
+TISSUE_MIN_FRACTION = float(os.getenv("TISSUE_MIN_FRACTION", "0.25"))
+# Le masque n'inspecte qu'un pixel sur N dans chaque direction
+TISSUE_MASK_STEP = 5
+
+
+def decode_large_image(image_bytes: bytes, max_bytes: int = TILING_MAX_UPLOAD_BYTES,
+                       max_pixels: int = TILING_MAX_PIXELS) -> np.ndarray:
+    """
+    Décode une grande image en BGR uint8, sans redimensionnement
+
+    Les dimensions sont lues dans l'en-tête avant le décodage : une image
+    au-delà de `max_pixels` est refusée sans allouer son buffer. Pas de
+    décodage en résolution réduite ici : les tuiles doivent rester au
+    grossissement des patchs d'entraînement.
+
+    Raises:
+        ImageRejectedError: Fichier trop volumineux, image trop grande ou format sans en-tête lisible
+        ValueError: Si l'image est illisible ou plus petite qu'un patch
+    """
+    if len(image_bytes) > max_bytes:
+        raise ImageRejectedError(f"Fichier trop volumineux pour le tuilage (maximum {max_bytes} octets)", 413)
+    header = read_image_size(image_bytes)
+    if header is None:
+        raise ImageRejectedError("Format non pris en charge pour le tuilage (PNG, JPEG, TIFF ou BMP)", 400)
+    _, width, height = header
+    if width * height > max_pixels:
+        raise ImageRejectedError(
+            f"Image trop grande pour le tuilage ({width}x{height}, maximum {max_pixels} pixels)", 413
+        )
+
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Image illisible")
+    if image.shape[0] < TILE_SIZE or image.shape[1] < TILE_SIZE:
+        raise ValueError(f"Image trop petite pour le tuilage (minimum {TILE_SIZE}x{TILE_SIZE})")
+    return image
+
+
+class ArrayBandReader:
+    """Bandes d'une image déjà décodée en mémoire"""
+
+    def __init__(self, image: np.ndarray):
+        self.image = image
+        self.shape = image.shape[:2]
+
+    def read_band(self, top: int, bottom: int, right: int) -> np.ndarray:
+        return self.image[top:bottom, :right]
+
+    def close(self):
+        self.image = None
+
+
+class TiffBandReader:
+    """
+    Lecture d'une TIFF bande par bande : seuls les strips ou les tuiles qui
+    recoupent la bande demandée sont lus et décodés, un segment à la fois
+
+    Raises:
+        ValueError: Si la TIFF ne peut pas être lue par bandes (le décodage complet prend alors le relais)
+    """
+
+    def __init__(self, image_file: BinaryIO):
+        import tifffile
+
+        # Nom explicite : le fichier temporaire d'un upload a un descripteur entier pour nom
+        self._tif = tifffile.TiffFile(image_file, name="upload.tif")
+        try:
+            page = self._tif.pages.first
+            self._page = page
+            photometric = int(page.photometric)
+            jpeg = int(page.compression) in (6, 7)
+            if (page.dtype != np.uint8 or page.imagedepth != 1 or page.samplesperpixel not in (1, 3, 4)
+                    or (page.samplesperpixel > 1 and int(page.planarconfig) != 1)
+                    or not (photometric in (1, 2) or (photometric == 6 and jpeg))):
+                raise ValueError("TIFF non lisible par bandes (uint8, 1, 3 ou 4 canaux entrelacés attendus)")
+            self.shape = (page.imagelength, page.imagewidth)
+            self._chunk_rows, self._chunk_cols = page.chunks[0], page.chunks[1]
+            self._chunks_across = page.chunked[1]
+            # Un segment décodé à titre d'essai : compression non prise en charge => décodage complet
+            list(self._decode_segments([0]))
+        except Exception:
+            self._tif.close()
+            raise
+
+    def _decode_segments(self, indices):
+        page = self._page
+        segments = self._tif.filehandle.read_segments(
+            [page.dataoffsets[i] for i in indices], [page.databytecounts[i] for i in indices], indices=indices
+        )
+        for data, index in segments:
+            try:
+                segment, position, _ = page.decode(data, index, jpegtables=page.jpegtables,
+                                                   jpegheader=page.jpegheader)
+            except Exception as e:
+                raise ValueError(f"Segment TIFF illisible: {type(e).__name__}: {e}")
+            yield segment[0], position[2], position[3]
+
+    def read_band(self, top: int, bottom: int, right: int) -> np.ndarray:
+        """Bande [top, bottom) x [0, right) en BGR uint8"""
+        band = np.empty((bottom - top, right, 3), dtype=np.uint8)
+        chunk_rows = range(top // self._chunk_rows, (bottom - 1) // self._chunk_rows + 1)
+        chunk_cols = range(0, (right - 1) // self._chunk_cols + 1)
+        indices = [row * self._chunks_across + col for row in chunk_rows for col in chunk_cols]
+
+        for segment, y, x in self._decode_segments(indices):
+            # Les segments de bord sont complétés au-delà de l'image : rognage
+            y0, y1 = max(y, top), min(y + segment.shape[0], bottom)
+            x1 = min(x + segment.shape[1], right)
+            pixels = segment[y0 - y:y1 - y, :x1 - x]
+            if pixels.shape[-1] == 1:
+                band[y0 - top:y1 - top, x:x1] = pixels
+            else:
+                band[y0 - top:y1 - top, x:x1] = pixels[..., 2::-1]
+        return band
+
+    def close(self):
+        self._tif.close()
+
+
+def open_large_image(image_file: BinaryIO, max_bytes: int = TILING_MAX_UPLOAD_BYTES,
+                     max_pixels: int = TILING_MAX_PIXELS):
+    """
+    Ouvre l'image à tuiler : lecteur par bandes pour les TIFF si tifffile sait
+    en décoder les segments, sinon décodage complet plafonné
+
+    Raises:
+        ImageRejectedError: Fichier trop volumineux, image trop grande ou format sans en-tête lisible
+        ValueError: Si l'image est illisible ou plus petite qu'un patch
+    """
+    image_file.seek(0)
+    if image_file.read(4) in _TIFF_MAGIC:
+        image_file.seek(0)
+        try:
+            reader = TiffBandReader(image_file)
+        except ImportError:
+            reader = None
+        except Exception as e:
+            print(f"⚠️ TIFF décodée en entier pour le tuilage: {e}")
+            reader = None
+        if reader is not None:
+            if reader.shape[0] < TILE_SIZE or reader.shape[1] < TILE_SIZE:
+                reader.close()
+                raise ValueError(f"Image trop petite pour le tuilage (minimum {TILE_SIZE}x{TILE_SIZE})")
+            return reader
+
+    image_file.seek(0)
+    # Lire au plus une limite + 1 octet suffit pour refuser un fichier trop gros
+    return ArrayBandReader(decode_large_image(image_file.read(max_bytes + 1), max_bytes, max_pixels))
+
+
+def band_rows_for(width: int, stride: int) -> int:
+    """Lignes de tuiles par bande, réduites pour qu'une bande reste sous BAND_MAX_PIXELS"""
+    fitting = (BAND_MAX_PIXELS // width - TILE_SIZE) // stride + 1
+    return max(1, min(TILING_BAND_ROWS, fitting))
+
+
+def tile_grid_shape(image_shape: Tuple[int, ...], stride: int) -> Tuple[int, int]:
+    """Nombre de lignes et de colonnes de tuiles pour un pas donné"""
+    rows = (image_shape[0] - TILE_SIZE) // stride + 1
+    cols = (image_shape[1] - TILE_SIZE) // stride + 1
+    return rows, cols
+
+
+def tissue_mask(tiles: np.ndarray) -> np.ndarray:
+    """
+    Masque vectorisé des tuiles contenant du tissu
+
+    Args:
+        tiles: Vue (rows, cols, 50, 50, 3) en BGR uint8
+
+    Returns:
+        Tableau booléen (rows, cols), True pour les tuiles à scorer
+    """
+    # Sous-échantillonnage par vue : aucune copie des tuiles complètes
+    sampled = tiles[:, :, ::TISSUE_MASK_STEP, ::TISSUE_MASK_STEP, :]
+    brightest = sampled.max(axis=-1)
+    darkest = sampled.min(axis=-1)
+    saturation = brightest.astype(np.int16) - darkest
+    is_tissue = (darkest < TISSUE_MAX_BRIGHTNESS) | (saturation > TISSUE_MIN_SATURATION)
+    return is_tissue.mean(axis=(-2, -1)) >= TISSUE_MIN_FRACTION
+
+
+def extract_band_tiles(reader, first_row: int, band_rows: int,
+                       stride: int, cols: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Extrait les tuiles de tissu d'une bande horizontale de l'image
+
+    Les tuiles sont des vues à pas (stride) sur la bande ; seules les tuiles
+    de tissu sont copiées (en BGR uint8, normalisées ensuite par batch).
+
+    Args:
+        reader: Lecteur de bandes de l'image (ArrayBandReader ou TiffBandReader)
+        first_row: Indice de la première ligne de tuiles de la bande
+        band_rows: Nombre de lignes de tuiles dans la bande
+        stride: Pas en pixels entre deux tuiles
+        cols: Nombre de colonnes de tuiles
+
+    Returns:
+        (tuiles (n, 50, 50, 3) uint8, positions (n, 2) ligne/colonne dans la grille)
+    """
+    top = first_row * stride
+    bottom = top + (band_rows - 1) * stride + TILE_SIZE
+    band = reader.read_band(top, bottom, (cols - 1) * stride + TILE_SIZE)
+
+    views = sliding_window_view(band, (TILE_SIZE, TILE_SIZE, 3))[::stride, ::stride, 0]
+    mask = tissue_mask(views)
+    positions = np.argwhere(mask)
+    positions[:, 0] += first_row
+
+    return views[mask], positions
+
+
+def downsample_heatmap(heatmap: np.ndarray, max_size: int = TILING_HEATMAP_MAX_SIZE) -> np.ndarray:
+    """Réduit la carte de chaleur par moyenne de blocs (le fond, NaN, est ignoré)"""
+    factor = int(np.ceil(max(heatmap.shape) / max_size))
+    if factor <= 1:
+        return heatmap
+
+    rows = int(np.ceil(heatmap.shape[0] / factor)) * factor
+    cols = int(np.ceil(heatmap.shape[1] / factor)) * factor
+    padded = np.full((rows, cols), np.nan, dtype=np.float32)
+    padded[:heatmap.shape[0], :heatmap.shape[1]] = heatmap
+
+    blocks = padded.reshape(rows // factor, factor, cols // factor, factor)
+    with warnings.catch_warnings():
+        # Blocs entièrement dans le fond : NaN attendu
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(blocks, axis=(1, 3))
+
+
+async def score_large_image(image_file: BinaryIO, scheduler: InferenceScheduler,
+                            stride: int = TILE_SIZE,
+                            batch_size: Optional[int] = None) -> dict:
+    """
+    Score une grande image par tuilage
+
+    Args:
+        image_file: Fichier binaire de l'image (l'upload, conservé sur disque au-delà de 1 Mo)
+        scheduler: Ordonnanceur qui possède le thread du modèle
+        stride: Pas en pixels entre deux tuiles (50 = sans recouvrement)
+        batch_size: Nombre de tuiles par appel au modèle
+
+    Returns:
+        Score agrégé sur les tuiles de tissu et carte de chaleur réduite
+
+    Raises:
+        ValueError: Si l'image est illisible ou les paramètres invalides
+    """
+    if stride < 1:
+        raise ValueError("Le pas (stride) doit être >= 1")
+    batch_size = batch_size or TILING_BATCH_SIZE
+
+    async with _tiling_slots:
+        reader = await run_in_decode_pool(open_large_image, image_file)
+        try:
+            return await _score_tiles(reader, scheduler, stride, batch_size)
+        finally:
+            reader.close()
+
+
+async def _score_tiles(reader, scheduler: InferenceScheduler, stride: int, batch_size: int) -> dict:
+    rows, cols = tile_grid_shape(reader.shape, stride)
+    if rows * cols > TILING_MAX_TILES:
+        raise ValueError(
+            f"Trop de tuiles ({rows * cols}) pour ce pas, maximum {TILING_MAX_TILES}: augmentez le stride"
+        )
+
+    heatmap = np.full((rows, cols), np.nan, dtype=np.float32)
+    pending_tiles, pending_positions, pending_count = [], [], 0
+
+    async def _flush():
+        nonlocal pending_tiles, pending_positions, pending_count
+        tiles = np.concatenate(pending_tiles)
+        positions = np.concatenate(pending_positions)
+        pending_tiles, pending_positions, pending_count = [], [], 0
+        for start in range(0, len(tiles), batch_size):
+            probas = await scheduler.run_batch(tiles[start:start + batch_size])
+            block = positions[start:start + batch_size]
+            heatmap[block[:, 0], block[:, 1]] = probas
+
+    rows_per_band = band_rows_for(reader.shape[1], stride)
+    for first_row in range(0, rows, rows_per_band):
+        band_rows = min(rows_per_band, rows - first_row)
+        tiles, positions = await run_in_decode_pool(
+            extract_band_tiles, reader, first_row, band_rows, stride, cols
+        )
+        if len(tiles):
+            pending_tiles.append(tiles)
+            pending_positions.append(positions)
+            pending_count += len(tiles)
+        if pending_count >= batch_size:
+            await _flush()
+
+    if pending_count:
+        await _flush()
+
+    scored = heatmap[~np.isnan(heatmap)]
+    summary = {
+        "image_size": [int(reader.shape[1]), int(reader.shape[0])],
+        "stride": stride,
+        "tiles_total": rows * cols,
+        "tiles_scored": int(scored.size),
+    }
+
+    if scored.size == 0:
+        summary.update({"label": "Aucun tissu détecté", "confidence": None,
+                        "max_probability": None, "positive_fraction": None, "heatmap": []})
+        return summary
+
+    reduced = downsample_heatmap(heatmap)
+    summary.update(format_prediction(float(scored.mean())))
+    summary.update({
+        "max_probability": float(scored.max()),
+        "positive_fraction": float((scored > 0.5).mean()),
+        "heatmap": [[None if np.isnan(value) else round(float(value), 4) for value in row] for row in reduced],
+    })
+    return summary
@@ -0,0 +1,311 @@
+"""
+Distillation du premier étage de la cascade d'inférence
+
+    python train_cascade.py ../0 ../1 --epochs 10
+    python train_cascade.py /data/idc --work-dir cascade_work --max-disagreement 0.002
+
+1. ResNet50 (mêmes poids et même prétraitement que l'API) score tous les
+   patchs : ses probabilités sont les cibles du petit CNN. Images et
+   cibles sont conservées dans --work-dir et réutilisées tant que les
+   entrées et les poids ne changent pas.
+2. Le CNN de cascade.create_student_model apprend ces cibles, avec
+   retournements et rotations aléatoires. Le découpage entraînement /
+   validation se fait par patient (préfixe du nom de fichier).
+3. Sur la validation, la bande d'incertitude est la plus étroite possible
+   tant que, de chaque côté, les décisions du premier étage restent
+   d'accord avec ResNet50 (--max-disagreement).
+
+Les poids et la bande sont écrits là où l'API les lit (cascade.py).
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from cascade import (CASCADE_STUDENT_METADATA, CASCADE_STUDENT_WEIGHTS, DECISION_THRESHOLD, create_student_model)
+from preprocessing import IMG_SIZE, to_model_input
+from score_dataset import decoded_batches, inputs_signature, label_from_filename, list_images
+
+# Pas de la recherche de la bande d'incertitude
+BAND_STEP = 0.01
+SPEED_BATCH_SIZE = 256
+
+
+def patient_id(path: str) -> str:
+    """Préfixe patient des patchs IDC (9346_idx5_x..._class1.png -> 9346)"""
+    return os.path.basename(path).split("_")[0]
+
+
+def validation_mask(paths, fraction: float) -> np.ndarray:
+    """Répartition stable par patient : tous les patchs d'un patient sont du même côté"""
+    def _bucket(path):
+        return int(hashlib.sha1(patient_id(path).encode()).hexdigest()[:8], 16) / 0xFFFFFFFF
+    return np.array([_bucket(path) < fraction for path in paths], dtype=bool)
+
+
+def distill_targets(paths, work_dir: str, batch_size: int, decode_workers: int):
+    """
+    Images décodées et probabilités ResNet50, en fichiers .npy projetés en mémoire
+
+    Returns:
+        (images uint8 (N, 50, 50, 3), probabilités ResNet50 (N,), masque des images lisibles, empreinte des poids)
+    """
+    from script import model_loader, predict_batch
+
+    model_loader.load()
+    fingerprint = model_loader.fingerprint
+    signature = inputs_signature(paths)
+
+    manifest_path = os.path.join(work_dir, "manifest.json")
+    images_path = os.path.join(work_dir, "images.npy")
+    targets_path = os.path.join(work_dir, "teacher.npy")
+    valid_path = os.path.join(work_dir, "valid.npy")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest == {"inputs_signature": signature, "weights_fingerprint": fingerprint, "images": len(paths)}:
+            print(f"Cibles ResNet50 réutilisées depuis {work_dir}")
+            return (np.load(images_path, mmap_mode="r"), np.load(targets_path), np.load(valid_path), fingerprint)
+
+    os.makedirs(work_dir, exist_ok=True)
+    images = np.lib.format.open_memmap(images_path, mode="w+", dtype=np.uint8,
+                                       shape=(len(paths), IMG_SIZE[1], IMG_SIZE[0], 3))
+    targets = np.zeros(len(paths), dtype=np.float32)
+    valid = np.zeros(len(paths), dtype=bool)
+
+    started = time.perf_counter()
+    offset = 0
+    with ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="decode") as executor:
+        for batch_paths, decoded, errors in decoded_batches(paths, batch_size, executor, prefetch=2):
+            indices = [offset + i for i, img in enumerate(decoded) if img is not None]
+            for error, path in zip(errors, batch_paths):
+                if error is not None:
+                    print(f"⚠️ {path} ignorée: {error}")
+            if indices:
+                batch = np.stack([img for img in decoded if img is not None])
+                images[indices] = batch
+                targets[indices] = predict_batch(batch)
+                valid[indices] = True
+            offset += len(batch_paths)
+            rate = offset / (time.perf_counter() - started)
+            print(f"  ResNet50 : {offset}/{len(paths)} patchs ({rate:.0f} patchs/s)")
+
+    images.flush()
+    np.save(targets_path, targets)
+    np.save(valid_path, valid)
+    # Écrit en dernier : un manifeste présent garantit des fichiers complets
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump({"inputs_signature": signature, "weights_fingerprint": fingerprint, "images": len(paths)}, f)
+    return images, targets, valid, fingerprint
+
+
+def _soft_targets(targets, labels, label_weight: float):
+    """Cibles de ResNet50, mêlées aux étiquettes réelles quand elles sont connues"""
+    if label_weight <= 0:
+        return targets
+    known = labels >= 0
+    mixed = targets.copy()
+    mixed[known] = (1.0 - label_weight) * targets[known] + label_weight * labels[known]
+    return mixed
+
+
+def training_batches(images, targets, indices, batch_size: int, rng):
+    """Batchs infinis mélangés, avec rotations de 90° et retournements aléatoires"""
+    while True:
+        order = rng.permutation(indices)
+        for start in range(0, len(order) - batch_size + 1, batch_size):
+            # Lecture triée : accès séquentiels dans le fichier projeté
+            batch_indices = np.sort(order[start:start + batch_size])
+            batch = np.asarray(images[batch_indices])
+            batch = np.rot90(batch, k=int(rng.integers(4)), axes=(1, 2))
+            flips = rng.random(len(batch)) < 0.5
+            batch = np.where(flips[:, None, None, None], batch[:, :, ::-1], batch)
+            # Copie : le buffer de to_model_input est réutilisé, et fit lit les batchs en avance
+            yield to_model_input(np.ascontiguousarray(batch)).copy(), targets[batch_indices]
+
+
+def predict_in_batches(model, images, indices, batch_size: int) -> np.ndarray:
+    """Probabilités du premier étage, dans l'ordre des indices triés"""
+    indices = np.sort(indices)
+    outputs = [np.asarray(model(to_model_input(np.asarray(images[indices[start:start + batch_size]])),
+                                training=False)).reshape(-1)
+               for start in range(0, len(indices), batch_size)]
+    return np.concatenate(outputs) if outputs else np.zeros(0, dtype=np.float32)
+
+
+def calibrate_band(student, teacher, max_disagreement: float) -> dict:
+    """
+    Bande [bas, haut] la plus étroite telle que, de chaque côté, la part des
+    patchs tranchés par le premier étage en désaccord avec ResNet50 reste
+    sous `max_disagreement`
+
+    Un côté n'est retenu que s'il tranche assez de patchs pour qu'un seul
+    désaccord soit mesurable (1 / max_disagreement) ; sinon la bande
+    s'étend jusqu'à 0 ou 1 et ResNet50 garde ces patchs.
+    """
+    teacher_positive = teacher > DECISION_THRESHOLD
+    grid = np.round(np.arange(0.0, DECISION_THRESHOLD + BAND_STEP / 2, BAND_STEP), 4)
+    min_support = int(np.ceil(1.0 / max_disagreement))
+
+    low = 0.0
+    for candidate in grid[::-1]:
+        decided = student < candidate
+        if decided.sum() >= min_support and teacher_positive[decided].mean() <= max_disagreement:
+            low = float(candidate)
+            break
+
+    high = 1.0
+    for candidate in (1.0 - grid)[::-1]:
+        decided = student > candidate
+        if decided.sum() >= min_support and (~teacher_positive[decided]).mean() <= max_disagreement:
+            high = float(candidate)
+            break
+
+    escalated = (student >= low) & (student <= high)
+    decisions = np.where(escalated, teacher_positive, student > DECISION_THRESHOLD)
+    return {
+        "low": low,
+        "high": high,
+        "escalation_rate": float(escalated.mean()),
+        "decision_agreement": float((decisions == teacher_positive).mean()),
+        "student_alone_agreement": float(((student > DECISION_THRESHOLD) == teacher_positive).mean()),
+    }
+
+
+def _latency_ms(fn, batch, repeats: int = 3) -> float:
+    fn(batch)
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn(batch)
+        timings.append((time.perf_counter() - started) * 1000.0)
+    return float(np.median(timings))
+
+
+def estimate_speedup(student, images, indices, escalation_rate: float) -> dict:
+    """Gain attendu sur CPU : un passage du premier étage plus ResNet50 sur la part escaladée"""
+    from script import predict_batch
+
+    sample = np.resize(np.asarray(images[np.sort(indices)[:SPEED_BATCH_SIZE]]),
+                       (SPEED_BATCH_SIZE, IMG_SIZE[1], IMG_SIZE[0], 3))
+    student_ms = _latency_ms(lambda batch: student(to_model_input(batch), training=False), sample)
+    teacher_ms = _latency_ms(predict_batch, sample)
+    cascade_ms = student_ms + escalation_rate * teacher_ms
+    return {
+        "batch_size": SPEED_BATCH_SIZE,
+        "student_ms": round(student_ms, 1),
+        "resnet50_ms": round(teacher_ms, 1),
+        "expected_speedup": round(teacher_ms / cascade_ms, 2),
+    }
+
+
+def train(args) -> dict:
+    from tensorflow import keras
+
+    paths = list_images(args.inputs)
+    if args.limit:
+        paths = paths[:args.limit]
+    if not paths:
+        raise ValueError("Aucune image trouvée")
+
+    print(f"{len(paths)} images, cibles ResNet50...")
+    images, teacher, valid, fingerprint = distill_targets(paths, args.work_dir, args.batch_size,
+                                                          args.decode_workers)
+    labels = np.array([-1 if label is None else label for label in map(label_from_filename, paths)],
+                      dtype=np.float32)
+
+    is_validation = validation_mask(paths, args.val_fraction)
+    train_indices = np.flatnonzero(valid & ~is_validation)
+    val_indices = np.flatnonzero(valid & is_validation)
+    if len(train_indices) < args.batch_size or not len(val_indices):
+        raise ValueError(f"Trop peu d'images ({len(train_indices)} en entraînement, {len(val_indices)} en validation) "
+                         f"pour un batch de {args.batch_size} : ajoutez des patchs ou réduisez --batch-size")
+
+    keras.utils.set_random_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    student = create_student_model(input_shape=(IMG_SIZE[1], IMG_SIZE[0], 3))
+    student.compile(optimizer=keras.optimizers.Adam(args.learning_rate), loss="binary_crossentropy")
+
+    targets = _soft_targets(teacher, labels, args.label_weight)
+    print(f"Entraînement : {len(train_indices)} patchs, validation : {len(val_indices)} patchs")
+    started = time.perf_counter()
+    history = student.fit(
+        training_batches(images, targets, train_indices, args.batch_size, rng),
+        steps_per_epoch=len(train_indices) // args.batch_size,
+        epochs=args.epochs,
+        verbose=2,
+    )
+    training_s = time.perf_counter() - started
+
+    val_student = predict_in_batches(student, images, val_indices, args.batch_size)
+    val_teacher = teacher[np.sort(val_indices)]
+    band = calibrate_band(val_student, val_teacher, args.max_disagreement)
+    speed = estimate_speedup(student, images, val_indices, band["escalation_rate"])
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    student.save_weights(args.output)
+    summary = {
+        "band": {"low": band["low"], "high": band["high"]},
+        "validation": {
+            "patches": int(len(val_indices)),
+            "max_disagreement": args.max_disagreement,
+            "escalation_rate": round(band["escalation_rate"], 4),
+            "decision_agreement": round(band["decision_agreement"], 5),
+            "student_alone_agreement": round(band["student_alone_agreement"], 5),
+            "mean_abs_error": round(float(np.abs(val_student - val_teacher).mean()), 5),
+        },
+        "speed": speed,
+        "training": {
+            "patches": int(len(train_indices)),
+            "epochs": args.epochs,
+            "batch_size": args.batch_size,
+            "label_weight": args.label_weight,
+            "final_loss": round(float(history.history["loss"][-1]), 5),
+            "elapsed_s": round(training_s, 1),
+        },
+        "teacher_weights_fingerprint": fingerprint,
+        "weights": args.output,
+        "created_at": time.time(),
+    }
+    with open(args.metadata, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    return summary
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Distille le premier étage de la cascade depuis ResNet50")
+    parser.add_argument("inputs", nargs="+", help="Dossiers (parcourus récursivement) ou images")
+    parser.add_argument("--work-dir", default="cascade_work", help="Images décodées et cibles ResNet50")
+    parser.add_argument("--output", default=CASCADE_STUDENT_WEIGHTS, help="Poids du premier étage (.weights.h5)")
+    parser.add_argument("--metadata", default=CASCADE_STUDENT_METADATA, help="Bande calibrée et rapport (JSON)")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--learning-rate", type=float, default=1e-3)
+    parser.add_argument("--val-fraction", type=float, default=0.1, help="Part des patients gardés pour la validation")
+    parser.add_argument("--label-weight", type=float, default=0.0,
+                        help="Poids des étiquettes réelles (noms ..._class0/1) dans les cibles")
+    parser.add_argument("--max-disagreement", type=float, default=0.005,
+                        help="Désaccord maximal avec ResNet50 de chaque côté de la bande")
+    parser.add_argument("--decode-workers", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--limit", type=int, help="N'utilise que les N premières images")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    try:
+        summary = train(args)
+    except (ValueError, FileNotFoundError, RuntimeError) as e:
+        print(f"⚠️ {e}")
+        return 1
+
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())